@@ -0,0 +1,121 @@
+""" -*- coding: UTF-8 -*-
+Bandwidth shaping for file downloads.
+
+Every download reports the bytes it receives to a shared token bucket,
+which holds the combined speed of all downloads to `ch_dl_bandwidth`
+MB/s. The limit is read again on every read, so changing the setting
+applies to downloads that are already running.
+
+`ch_dl_offpeak_hours` lists the times of day when large batch downloads
+are allowed to start, e.g. "22:00-06:00, 12:00-13:30". Outside those
+windows the download manager keeps them queued.
+"""
+from __future__ import annotations
+import datetime
+import re
+from . import util
+from . import rate_limit
+
+MB = 1024 * 1024
+
+# smallest number of tokens the bucket saves up, so a single read never waits twice
+MIN_BURST = 256 * 1024
+
+WINDOW_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})$")
+
+_bucket = rate_limit.TokenBucket(MB, MB)
+
+# (setting text, [(start minute, end minute)])
+_windows = ("", [])
+
+
+def get_limit() -> int:
+    """ return: combined download speed limit in bytes per second, 0 if unlimited """
+    limit = float(util.get_opts("ch_dl_bandwidth") or 0)
+    return int(max(limit, 0) * MB)
+
+
+def throttle(size:int) -> None:
+    """ Waits until `size` more bytes may be downloaded """
+    limit = get_limit()
+    if not limit:
+        return
+
+    # allow a second of traffic at once
+    burst = max(limit, MIN_BURST)
+    if (limit, burst) != (_bucket.rate, _bucket.burst):
+        _bucket.configure(limit, burst)
+
+    _bucket.consume(size)
+
+
+def parse_windows(text:str) -> list[tuple[int, int]]:
+    """
+    Parses a list of time ranges, "HH:MM-HH:MM" separated by commas.
+    A range that ends before it starts wraps around midnight.
+
+    return: list of (start, end) in minutes after midnight
+    """
+    windows = []
+    for window in text.split(","):
+        window = window.strip()
+        if not window:
+            continue
+
+        match = WINDOW_PATTERN.match(window)
+        if not match:
+            util.printD(f"Ignoring invalid off-peak window: {window}")
+            continue
+
+        start_hour, start_minute, end_hour, end_minute = (int(part) for part in match.groups())
+        if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+            util.printD(f"Ignoring invalid off-peak window: {window}")
+            continue
+
+        windows.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute))
+
+    return windows
+
+
+def get_windows() -> list[tuple[int, int]]:
+    """ return: off-peak windows from settings, parsed once per change """
+    global _windows
+
+    text = util.get_opts("ch_dl_offpeak_hours") or ""
+    if text != _windows[0]:
+        _windows = (text, parse_windows(text))
+
+    return _windows[1]
+
+
+def is_offpeak(now:datetime.datetime | None=None) -> bool:
+    """ return: True if large downloads may start now, always True without windows """
+    windows = get_windows()
+    if not windows:
+        return True
+
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+
+    for start, end in windows:
+        if start <= end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:
+            return True
+
+    return False
+
+
+def get_offpeak_size() -> int:
+    """ return: size in bytes from which batch downloads wait for off-peak hours """
+    size_mb = util.get_opts("ch_dl_offpeak_size")
+    if size_mb is None:
+        size_mb = 100
+
+    return int(float(size_mb) * MB)
+
+
+def must_wait(size:int) -> bool:
+    """ return: True if a download of `size` bytes should wait for off-peak hours """
+    return size >= get_offpeak_size() and not is_offpeak()
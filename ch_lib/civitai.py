@@ -2,22 +2,74 @@
 handle msg between js and python side
 """
 
+import contextlib
+import copy
 import os
 import re
+import threading
+import urllib.parse
 from . import util
+from . import json_codec
 from . import model
 from . import downloader
+from . import hash_cache
+from . import inventory
+from . import version_index
+from . import response_cache
+from . import rate_limit
 
 SUFFIX = ".civitai"
 
-URLS = {
-    "query": "https://civitai.com/api/v1/models?",
-    "modelPage": "https://civitai.com/models/",
-    "modelId": "https://civitai.com/api/v1/models/",
-    "modelVersionId": "https://civitai.com/api/v1/model-versions/",
-    "hash": "https://civitai.com/api/v1/model-versions/by-hash/"
+# {(model_type, search_term, model_folders): info_file}
+_search_term_paths = {}
+
+BASE_URL = "https://civitai.com"
+
+URLS = {}
+
+
+def set_base_url(base_url: str = None) -> None:
+    """
+    Points URLS at a Civitai instance, e.g. a local stand-in server
+    (see tools/civitai_stub_server.py). Defaults to civitai.com.
+    """
+    base_url = (base_url or BASE_URL).strip().rstrip("/")
+
+    URLS.update({
+        "query": f"{base_url}/api/v1/models?",
+        "modelPage": f"{base_url}/models/",
+        "modelId": f"{base_url}/api/v1/models/",
+        "modelVersionId": f"{base_url}/api/v1/model-versions/",
+        "hash": f"{base_url}/api/v1/model-versions/by-hash/",
+        "hashes": f"{base_url}/api/v1/model-versions/by-hash"
+    })
+
+
+set_base_url()
+
+# models requested at once when fetching models by id
+QUERY_BATCH_SIZE = 100
+
+# hashes looked up at once when fetching model versions by hash
+HASH_BATCH_SIZE = 100
+
+# seconds responses from each endpoint are reused before revalidating them
+CACHE_TTLS = {
+    "query": 60 * 10,
+    "modelId": 60 * 60,
+    "modelVersionId": 60 * 60 * 24,
+    "hash": 60 * 60 * 24,
 }
 
+# civitai_get requests in progress: {url: {"done": Event, "content": json}}
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# parent models fetched during the current operation, see memoize_parent_models
+_parent_models = None
+_parent_models_users = 0
+_parent_models_lock = threading.Lock()
+
 MODEL_TYPES = {
     "Checkpoint": "ckp",
     "TextualInversion": "ti",
@@ -61,25 +113,109 @@ NSFW_LEVELS = {
 }
 
 
+def get_cache_ttl(civitai_url: str) -> int:
+    """ return: seconds a response from this url can be reused without revalidating it """
+    for endpoint, ttl in CACHE_TTLS.items():
+        if civitai_url.startswith(URLS[endpoint]):
+            return ttl
+
+    return 0
+
+
+def get_download_headers() -> dict:
+    """ return: headers for downloading files from Civitai, with the API key if set """
+    headers = {
+        "content-type": "application/json"
+    }
+    api_key = util.get_opts("ch_civiai_api_key")
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    return headers
+
+
 def civitai_get(civitai_url: str):
     """
     Gets JSON from Civitai.
+    Concurrent calls for the same url share a single request,
+    each caller gets its own copy of the result.
+    return: dict:json or None
+    """
+
+    with _in_flight_lock:
+        request = _in_flight.get(civitai_url, None)
+        leader = request is None
+        if leader:
+            request = {"done": threading.Event(), "content": None, "waiters": 0}
+            _in_flight[civitai_url] = request
+        else:
+            request["waiters"] = request["waiters"] + 1
+
+    if not leader:
+        util.printD(f"Waiting for identical request: {civitai_url}")
+        request["done"].wait()
+        return copy.deepcopy(request["content"])
+
+    content = None
+    try:
+        content = fetch_civitai_json(civitai_url)
+    finally:
+        # no one can join once the request is removed
+        with _in_flight_lock:
+            del _in_flight[civitai_url]
+            waiters = request["waiters"]
+
+        if waiters:
+            # snapshot before the caller can modify the result
+            request["content"] = copy.deepcopy(content)
+        request["done"].set()
+
+    return content
+
+
+def fetch_civitai_json(civitai_url: str):
+    """
+    Gets JSON from Civitai, without coalescing concurrent requests.
+    Responses are cached, see response_cache.
     return: dict:json or None
     """
 
+    entry = response_cache.get(civitai_url)
+    if entry and response_cache.is_fresh(entry, get_cache_ttl(civitai_url)):
+        content = response_cache.load_content(entry)
+        if content is not None:
+            util.printD(f"Using cached Civitai response: {civitai_url}")
+            return content
+        entry = None
+
     util.printD(f"Requesting Civitai: {civitai_url}")
 
+    rate_limit.acquire()
     success, response = downloader.request_get(
-        civitai_url
+        civitai_url,
+        headers=response_cache.get_conditional_headers(entry)
     )
 
     if not success:
         return None
 
+    if response.status_code == 304 and entry:
+        response.close()
+        content = response_cache.load_content(entry)
+        if content is not None:
+            response_cache.revalidated(entry)
+            return content
+
+        # the cached copy went missing, fetch it again
+        rate_limit.acquire()
+        success, response = downloader.request_get(civitai_url)
+        if not success:
+            return None
+
     # try to get content
     content = None
     try:
-        content = response.json()
+        content = json_codec.loads(response.content)
     except ValueError as e:
         util.printD(util.indented_msg(
             f"""
@@ -90,10 +226,80 @@ def civitai_get(civitai_url: str):
         ))
         return None
 
+    if content:
+        response_cache.store(civitai_url, content, response.headers)
+
     return content
 
 
-def append_parent_model_metadata(content):
+def civitai_post(civitai_url: str, data):
+    """
+    Posts JSON to Civitai. Responses are not cached.
+    return: json or None
+    """
+
+    util.printD(f"Posting to Civitai: {civitai_url}")
+
+    rate_limit.acquire()
+    success, response = downloader.request_post(civitai_url, data)
+
+    if not success:
+        return None
+
+    try:
+        return json_codec.loads(response.content)
+    except ValueError as e:
+        util.printD(f"Parse response json failed: {e}")
+        return None
+
+
+@contextlib.contextmanager
+def memoize_parent_models():
+    """
+    Within this context, each parent model is fetched from Civitai at most
+    once, no matter how many of its versions are resolved. Nested and
+    concurrent operations share the memo until the last one ends.
+    """
+    global _parent_models, _parent_models_users
+
+    with _parent_models_lock:
+        if _parent_models is None:
+            _parent_models = {}
+        _parent_models_users = _parent_models_users + 1
+
+    try:
+        yield
+    finally:
+        with _parent_models_lock:
+            _parent_models_users = _parent_models_users - 1
+            if not _parent_models_users:
+                _parent_models = None
+
+
+def remember_parent_model(model_info: dict) -> None:
+    """ Adds a fetched model to the parent model memo, if one is active """
+    with _parent_models_lock:
+        if _parent_models is not None and model_info:
+            _parent_models[model_info["id"]] = model_info
+
+
+def get_parent_model(model_id) -> dict:
+    """
+    Fetches a parent model, using the memo of the current operation if any.
+    return: dict:model_info
+    """
+    with _parent_models_lock:
+        if _parent_models is not None and model_id in _parent_models:
+            return _parent_models[model_id]
+
+    util.printD("Fetching Parent Model Information")
+    parent_model = get_model_info_by_id(model_id)
+    remember_parent_model(parent_model)
+
+    return parent_model
+
+
+def append_parent_model_metadata(content, parent_model=None):
     """
     Some model metadata is stored in a "parent" context.
     When we're fething a model by its hash, we're getting
@@ -103,11 +309,13 @@ def append_parent_model_metadata(content):
     This method gets the parent metadata and appends it to
     our model file metadata.
 
+    parent_model: parent model info fetched ahead of time, if any
+
     return: model metadata with parent description, creator,
     and permissions appended.
     """
-    util.printD("Fetching Parent Model Information")
-    parent_model = get_model_info_by_id(content["modelId"])
+    if parent_model is None:
+        parent_model = get_parent_model(content["modelId"])
 
     if not parent_model:
         # Archived models can give the model version information but 404 on the model metadata itself.
@@ -160,6 +368,75 @@ def get_model_info_by_hash(model_hash: str):
     return content
 
 
+def get_models_info_by_hashes(model_hashes: list) -> dict:
+    """
+    Looks up many hashes at once, HASH_BATCH_SIZE hashes per request,
+    using the bulk form of the by-hash endpoint. Hashes from batches that
+    failed are looked up one at a time, through the same worker pool.
+
+    return: dict {hash: model_info}, with model_info {} for hashes civitai
+        does not know or that could not be looked up.
+    """
+    unique_hashes = []
+    for model_hash in model_hashes:
+        if model_hash and model_hash.upper() not in unique_hashes:
+            unique_hashes.append(model_hash.upper())
+
+    def lookup_batch(batch):
+        util.printD(f"Request info for {len(batch)} hashes from civitai")
+
+        content = civitai_post(URLS["hashes"], batch)
+        if not isinstance(content, list):
+            return None
+
+        found = {}
+        for version_info in content:
+            for file_info in version_info.get("files", []):
+                for file_hash in file_info.get("hashes", {}).values():
+                    if f"{file_hash}".upper() in batch:
+                        found[file_hash.upper()] = version_info
+
+        return {model_hash: found.get(model_hash, {}) for model_hash in batch}
+
+    batches = [
+        unique_hashes[start:start + HASH_BATCH_SIZE]
+        for start in range(0, len(unique_hashes), HASH_BATCH_SIZE)
+    ]
+
+    models_info = {}
+    failed = []
+    for batch, found in zip(batches, rate_limit.map_requests(lookup_batch, batches)):
+        if found is None:
+            failed.extend(batch)
+        else:
+            models_info.update(found)
+
+    def lookup_hash(model_hash):
+        try:
+            return civitai_get(f'{URLS["hash"]}{model_hash}')
+        except Exception as e:
+            util.printD(f"Failed to get model info by hash: {model_hash}")
+            util.printD(f"Error: {str(e)}")
+            return None
+
+    for model_hash, version_info in zip(failed, rate_limit.map_requests(lookup_hash, failed)):
+        models_info[model_hash] = version_info or {}
+
+    # fetch parent models in batches as well
+    parents = get_models_info_by_ids(
+        [version_info["modelId"] for version_info in models_info.values() if version_info]
+    )
+
+    for model_hash, version_info in models_info.items():
+        if version_info:
+            # files sharing a version each get their own copy, as callers modify it
+            models_info[model_hash] = append_parent_model_metadata(
+                copy.deepcopy(version_info), parents.get(version_info["modelId"], {})
+            )
+
+    return models_info
+
+
 def get_model_info_by_id(model_id: str) -> dict:
     """
     Fetches model info by its model id.
@@ -177,9 +454,10 @@ def get_model_info_by_id(model_id: str) -> dict:
     return content
 
 
-def get_version_info_by_version_id(version_id: str) -> dict:
+def get_version_info_by_version_id(version_id: str, parent_model: dict = None) -> dict:
     """
     Gets model version info from Civitai by version id
+    parent_model: the version's model info, if the caller already has it
     return: dict:model_info
     """
     util.printD("Request version info from civitai")
@@ -191,7 +469,7 @@ def get_version_info_by_version_id(version_id: str) -> dict:
     content = civitai_get(f'{URLS["modelVersionId"]}{version_id}')
 
     if content:
-        content = append_parent_model_metadata(content)
+        content = append_parent_model_metadata(content, parent_model)
 
     return content
 
@@ -225,7 +503,7 @@ def get_version_info_by_model_id(model_id: str) -> dict:
         return None
 
     # get version info
-    version_info = get_version_info_by_version_id(f"{version_id}")
+    version_info = get_version_info_by_version_id(f"{version_id}", model_info)
     if not version_info:
         util.printD(f"Failed to get version info by version_id: {version_id}")
         return None
@@ -256,6 +534,15 @@ def load_model_info_by_search_term(model_type, search_term):
     else:
         model_folders = [model.folders[model_type]]
 
+    memo_key = (model_type, search_term, tuple(model_folders))
+    model_info_filepath = _search_term_paths.get(memo_key, None)
+    if model_info_filepath:
+        try:
+            return model.load_model_info(model_info_filepath)
+        except OSError:
+            # moved or removed since it was found
+            _search_term_paths.pop(memo_key, None)
+
     for model_folder in model_folders:
         model_info_filename = f"{model_info_base}{SUFFIX}{model.CIVITAI_EXT}"
         model_info_filepath = os.path.join(model_folder, model_info_filename)
@@ -269,6 +556,8 @@ def load_model_info_by_search_term(model_type, search_term):
         util.printD(f"Can not find model info file: {model_info_filepath}")
         return None
 
+    _search_term_paths[memo_key] = model_info_filepath
+
     return model.load_model_info(model_info_filepath)
 
 
@@ -280,11 +569,6 @@ def get_model_names_by_type_and_filter(model_type: str, metadata_filter: dict) -
     return: model name list
     """
 
-    if model_type == "lora" and model.folders['lycoris']:
-        model_folders = [model.folders[model_type], model.folders['lycoris']]
-    else:
-        model_folders = [model.folders[model_type]]
-
     # set metadata_filter
     # only get models don't have a civitai info file
     no_info_only = False
@@ -297,33 +581,27 @@ def get_model_names_by_type_and_filter(model_type: str, metadata_filter: dict) -
     # get information from filter
     # only get those model names don't have a civitai model info file
     model_names = []
-    for model_folder in model_folders:
-        for root, _, files in os.walk(model_folder, followlinks=True):
-            for filename in files:
-                if is_valid_file(root, filename, no_info_only, empty_info_only):
-                    model_names.append(filename)
+    for record in inventory.get_models(model_type, with_lycoris=True):
+        if is_valid_file(record, no_info_only, empty_info_only):
+            model_names.append(record["name"])
 
     return model_names
 
 
-def is_valid_file(root, filename, no_info_only, empty_info_only):
+def is_valid_file(record, no_info_only, empty_info_only):
     """
     Filters through model files to determine if they are
     valid targets for downloading new metadata.
 
+    record: model record from the inventory
+
     return: bool
     """
-    item = os.path.join(root, filename)
-    # check extension
-    base, ext = os.path.splitext(item)
-    if ext not in model.EXTS:
-        return False
-
-    # find a model
+    base, _ = os.path.splitext(record["path"])
     info_file = f"{base}{SUFFIX}{model.CIVITAI_EXT}"
 
     # check filter
-    if os.path.isfile(info_file):
+    if record["info"]:
         if no_info_only:
             return False
 
@@ -530,9 +808,9 @@ def get_preview_image_by_model_path(model_path: str, max_size_preview, nsfw_prev
 
 # search local model by version id in 1 folder, no subfolder
 # return - model_info
-def search_local_model_info_by_version_id(folder: str, model_ids: dict) -> dict:
-    """ Searches a folder for model_info files,
-        returns the model_info from a file if its id matches the model id.
+def search_local_model_info_by_version_id(folder: str, model_ids: dict) -> str:
+    """ Searches a folder for a downloaded model version,
+        returns the model path if its ids match the model ids.
     """
     util.printD("Searching local model by version id")
     util.printD(f"folder: {folder}")
@@ -553,34 +831,9 @@ def search_local_model_info_by_version_id(folder: str, model_ids: dict) -> dict:
         util.printD("missing ID for model/version")
         return None
 
-    # search civitai model info file
-    for filename in os.listdir(folder):
-        # check ext
-        base, ext = os.path.splitext(filename)
-        if ext == model.CIVITAI_EXT:
-            # find info file
-            if not (len(base) > 8 and base[-8:] == SUFFIX):
-                # not a civitai info file
-                continue
-
-            # find a civitai info file
-            path = os.path.join(folder, filename)
-
-            try:
-                model_info = model.load_model_info(path)
-                existing_version_id = model_info.get("id", None)
-                existing_model_id = model_info["modelId"]
-
-            except Exception:
-                continue
-
-            # util.printD(f"Compare version id, src: {model_id}, target:{version_id}")
-            if f"{existing_version_id}" == f"{version_id}":
-                # find the one
-                filepath = model.locate_model_from_partial(folder, base[:-8])
-                return f"{filepath}"
-
-    return None
+    # the version index is kept up to date as info files are written,
+    # so this does not need to parse every info file in the folder
+    return version_index.lookup(folder, model_id, version_id)
 
 
 def get_model_id_from_model_path(model_path: str):
@@ -603,9 +856,64 @@ def get_model_id_from_model_path(model_path: str):
     return (model_id, local_version_id)
 
 
-def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tuple:
+def get_models_info_by_ids(model_ids: list) -> dict:
+    """
+    Fetches model info for many models, QUERY_BATCH_SIZE models per request,
+    instead of requesting each model separately.
+    Models missing from the results, e.g. archived ones, are requested individually.
+    return: dict {model_id: model_info}
+    """
+    unique_ids = []
+    for model_id in model_ids:
+        if model_id and model_id not in unique_ids:
+            unique_ids.append(model_id)
+
+    def query_batch(batch):
+        util.printD(f"Request info for {len(batch)} models from civitai")
+
+        params = urllib.parse.urlencode({
+            "ids": batch,
+            "limit": QUERY_BATCH_SIZE,
+            "nsfw": "true",
+        }, doseq=True)
+        url = f'{URLS["query"]}{params}'
+
+        items = []
+        while url:
+            content = civitai_get(url)
+            if not content:
+                break
+
+            items.extend(content.get("items", []))
+            url = content.get("metadata", {}).get("nextPage", None)
+
+        return items
+
+    batches = [
+        unique_ids[start:start + QUERY_BATCH_SIZE]
+        for start in range(0, len(unique_ids), QUERY_BATCH_SIZE)
+    ]
+
+    models_info = {}
+    for items in rate_limit.map_requests(query_batch, batches):
+        for model_info in items:
+            models_info[model_info["id"]] = model_info
+
+    missing = [model_id for model_id in unique_ids if model_id not in models_info]
+    for model_id, model_info in zip(missing, rate_limit.map_requests(get_model_info_by_id, missing)):
+        if model_info:
+            models_info[model_id] = model_info
+
+    for model_info in models_info.values():
+        remember_parent_model(model_info)
+
+    return models_info
+
+
+def check_model_new_version_by_path(model_path: str, models_info: dict = None) -> tuple:
     """
     check new version for a model by model path
+    models_info: prefetched model info by model id, see get_models_info_by_ids
     return (
         model_path, model_id, model_name, new_verion_id,
         new_version_name, description, download_url, img_url
@@ -622,10 +930,11 @@ def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tupl
 
     model_id, local_version_id = result
 
-    # get model info by id from civitai
-    model_info = get_model_info_by_id(model_id)
-
-    util.delay(delay)
+    if models_info and model_id in models_info:
+        model_info = models_info[model_id]
+    else:
+        # get model info by id from civitai
+        model_info = get_model_info_by_id(model_id)
 
     if not model_info:
         return None
@@ -663,8 +972,9 @@ def check_model_new_version_by_path(model_path: str, delay: float = 0.2) -> tupl
     )
 
 
-def check_single_model_new_version(root, filename, model_type, delay):
+def check_single_model_new_version(root, filename, model_type, models_info=None):
     """
+    models_info: prefetched model info by model id, see get_models_info_by_ids
     return: True if a valid model has a new version.
     """
     # check ext
@@ -675,7 +985,7 @@ def check_single_model_new_version(root, filename, model_type, delay):
         return False
 
     # find a model
-    request = check_model_new_version_by_path(item, delay)
+    request = check_model_new_version_by_path(item, models_info)
 
     if not request:
         return False
@@ -701,10 +1011,9 @@ def check_single_model_new_version(root, filename, model_type, delay):
     return request
 
 
-def check_models_new_version_by_model_types(model_types: list, delay: float = 0.2) -> list:
+def check_models_new_version_by_model_types(model_types: list) -> list:
     """
     check all models of model_types for new version
-    parameter: delay - float, how many seconds to delay between each request to civitai
     return: new_versions
         a list for all new versions, each one is
         (model_path, model_id, model_name, new_verion_id,
@@ -731,27 +1040,41 @@ def check_models_new_version_by_model_types(model_types: list, delay: float = 0.
     new_version_ids = []
 
     # walk all models
+    models = []
     for model_type, model_folder in model.folders.items():
         if model_type not in mts:
             continue
 
         util.printD(f"Scanning path: {model_folder}")
-        for root, _, files in os.walk(model_folder, followlinks=True):
-            for filename in files:
-                version = check_single_model_new_version(root, filename, model_type, delay)
+        for record in list(inventory.get_folder(model_folder, force_refresh=True)["models"].values()):
+            models.append((model_type, record))
+
+    # several local files can be versions of the same model,
+    # so each model is only requested once
+    model_ids = []
+    for _, record in models:
+        ids = inventory.get_info_ids(record)
+        if ids:
+            model_ids.append(ids[0])
 
-                if not version:
-                    continue
+    models_info = get_models_info_by_ids(model_ids)
 
-                # model_path, model_id, model_name, version_id, new_version_name, description, downloadUrl, img_url = version
-                version_id = version[3]
+    for model_type, record in models:
+        root, filename = os.path.split(record["path"])
+        version = check_single_model_new_version(root, filename, model_type, models_info)
 
-                if version_id in new_version_ids:
-                    continue
+        if not version:
+            continue
 
-                # add to list
-                new_versions.append(version)
-                new_version_ids.append(version_id)
+        # model_path, model_id, model_name, version_id, new_version_name, description, downloadUrl, img_url = version
+        version_id = version[3]
+
+        if version_id in new_version_ids:
+            continue
+
+        # add to list
+        new_versions.append(version)
+        new_version_ids.append(version_id)
 
     return new_versions
 
@@ -762,7 +1085,7 @@ def move_model_to_subfolder(filepath, model_info):
     if model_id == "":
         return None
 
-    content = civitai_get(f'{URLS["modelId"]}{model_id}')
+    content = get_parent_model(model_id)
 
     tags = content["tags"]
 
@@ -796,6 +1119,10 @@ def move_model_to_subfolder(filepath, model_info):
             # move the file to the new folder
             new_filepath = os.path.join(new_folder_path, os.path.basename(filepath))
             os.rename(filepath, new_filepath)
+            hash_cache.move(filepath, new_filepath)
+            inventory.update_model(filepath)
+            inventory.update_model(new_filepath)
+            version_index.move(filepath, new_filepath)
 
             return new_filepath
 
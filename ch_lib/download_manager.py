@@ -0,0 +1,461 @@
+""" -*- coding: UTF-8 -*-
+Persistent download queue.
+
+The UI submits download jobs here instead of downloading inside its own
+request. Jobs are saved to disk as soon as they are submitted and run in
+background threads, highest priority first and in submission order within
+a priority, limited to `ch_dl_concurrency` downloads at once and
+`ch_dl_per_host` downloads from a single host. Large batch downloads
+wait for the off-peak hours set in `ch_dl_offpeak_hours`.
+
+The saved progress of a partial download records the job that owns it.
+When the webui starts again, jobs that were queued or running are run
+again, which resumes their `.downloading` files. Partial files left
+behind by downloads outside of the queue are resumed on their own, as
+long as their saved progress records the url they came from. Partials
+of failed or cancelled jobs are left alone.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+import urllib.parse
+import uuid
+from . import util
+from . import json_codec
+from . import model
+from . import inventory
+from . import civitai
+from . import downloader
+from . import bandwidth
+from . import model_action_civitai
+
+QUEUE_FILE = "downloads.json"
+QUEUE_VERSION = 1
+
+DEFAULT_CONCURRENCY = 2
+DEFAULT_PER_HOST = 2
+
+# finished jobs kept for the status display
+KEEP_FINISHED = 50
+
+STATUS_SECONDS = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+PRIORITY_BATCH = 0
+PRIORITY_SINGLE = 1
+
+_cond = threading.Condition()
+
+# [{"id": str, "kind": "model" | "file", "name": str, "host": str,
+#   "priority": int, "seq": int, "size": int, "status": str, "message": str, ...}]
+_jobs = None
+
+_scheduler = None
+
+
+def get_queue_path() -> str:
+    """ return: path to the persisted queue """
+    return os.path.join(util.get_cache_dir(), QUEUE_FILE)
+
+
+def load_queue() -> None:
+    """ Loads the persisted queue on first use """
+    global _jobs
+
+    if _jobs is not None:
+        return
+
+    _jobs = []
+
+    path = get_queue_path()
+    if not os.path.isfile(path):
+        return
+
+    try:
+        data = json_codec.load_file(path)
+
+        if data.get("version", None) == QUEUE_VERSION:
+            _jobs = data.get("jobs", [])
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not load download queue: {e}")
+
+
+def save_queue() -> None:
+    """ Writes the queue to disk. Must be called holding _cond. """
+    finished = [job for job in _jobs if job["status"] in FINISHED]
+    for job in finished[:-KEEP_FINISHED]:
+        _jobs.remove(job)
+
+    data = {
+        "version": QUEUE_VERSION,
+        "jobs": _jobs,
+    }
+
+    try:
+        util.write_json_atomic(get_queue_path(), data)
+    except OSError as e:
+        util.printD(f"Could not save download queue: {e}")
+
+
+def get_limits() -> tuple[int, int]:
+    """ return: (downloads at once, downloads at once per host) from settings """
+    concurrency = int(util.get_opts("ch_dl_concurrency") or DEFAULT_CONCURRENCY)
+    per_host = int(util.get_opts("ch_dl_per_host") or DEFAULT_PER_HOST)
+
+    return (max(concurrency, 1), max(per_host, 1))
+
+
+def get_host(url:str) -> str:
+    """ return: host a job downloads from """
+    return urllib.parse.urlparse(url).netloc.lower()
+
+
+def add_job(job:dict) -> str:
+    """
+    Adds a job to the queue and wakes the scheduler.
+
+    return: job id
+    """
+    with _cond:
+        load_queue()
+
+        job.update({
+            "id": uuid.uuid4().hex[:12],
+            "seq": max((queued["seq"] for queued in _jobs), default=0) + 1,
+            "status": QUEUED,
+            "message": "Waiting to download",
+            "created": time.time(),
+        })
+        _jobs.append(job)
+
+        save_queue()
+        _cond.notify_all()
+
+    start()
+
+    return job["id"]
+
+
+def submit(
+    model_info:dict,
+    model_type:str,
+    subfolder:str,
+    version_str:str,
+    filename:str,
+    file_ext:str,
+    dl_all:bool,
+    duplicate:str,
+    preview:str,
+    filetypes:list,
+    priority:int=PRIORITY_SINGLE
+) -> str:
+    """
+    Queues a model download. Takes the same parameters as
+    model_action_civitai.dl_model_by_input, with the file type
+    checkboxes passed as a list.
+
+    return: job id
+    """
+    version = model_action_civitai.get_ver_info_by_ver_str(version_str, model_info) or {}
+    sizes = [file.get("sizeKB", 0) for file in version.get("files", [])]
+
+    return add_job({
+        "kind": "model",
+        "name": model_info.get("name", f"{model_info['id']}"),
+        "host": get_host(civitai.BASE_URL),
+        "priority": priority,
+        # the model file, which is most of the download
+        "size": int(max(sizes, default=0) * 1024),
+        "model_id": model_info["id"],
+        "model_type": model_type,
+        "subfolder": subfolder,
+        "version_str": version_str,
+        "filename": filename,
+        "file_ext": file_ext,
+        "dl_all": dl_all,
+        "duplicate": duplicate,
+        "preview": preview,
+        "filetypes": list(filetypes),
+    })
+
+
+def submit_file(url:str, file_path:str, size:int=0, priority:int=PRIORITY_BATCH) -> str:
+    """
+    Queues the download of a single file to `file_path`.
+    size: expected size of the file in bytes, if known
+
+    return: job id
+    """
+    return add_job({
+        "kind": "file",
+        "name": os.path.basename(file_path),
+        "host": get_host(url),
+        "priority": priority,
+        "size": size,
+        "url": url,
+        "file_path": file_path,
+    })
+
+
+def cancel(job_id:str) -> bool:
+    """
+    Cancels a job that has not started yet.
+
+    return: True if the job was cancelled
+    """
+    with _cond:
+        load_queue()
+
+        for job in _jobs:
+            if job["id"] == job_id and job["status"] == QUEUED:
+                job["status"] = CANCELLED
+                job["message"] = "Cancelled"
+                save_queue()
+                return True
+
+    return False
+
+
+def find_partials() -> list[str]:
+    """
+    Looks for interrupted downloads in model folders.
+
+    return: list of file paths with an unfinished download
+    """
+    found = []
+    for folder in set(model.folders.values()):
+        if not (folder and os.path.isdir(folder)):
+            continue
+
+        for partial in inventory.get_partials(folder, force_refresh=True):
+            found.append(partial[:-len(downloader.DL_EXT)])
+
+    return found
+
+
+def recover() -> None:
+    """
+    Requeues jobs that were interrupted by a restart, and queues the
+    partial downloads of no job that can still be resumed.
+    """
+    with _cond:
+        load_queue()
+
+        for job in _jobs:
+            if job["status"] == RUNNING:
+                job["status"] = QUEUED
+                job["message"] = "Waiting to resume"
+
+        save_queue()
+
+    for file_path in find_partials():
+        try:
+            state = json_codec.load_file(downloader.get_state_path(file_path))
+        except (OSError, ValueError):
+            # without the url, it can only be downloaded again from the start
+            util.printD(f"Can not resume download without saved progress: {file_path}")
+            continue
+
+        # requeued jobs resume their own partials,
+        # failed and cancelled ones are not retried
+        if state.get("job", None) or not state.get("url", None):
+            continue
+
+        util.printD(f"Resuming interrupted download: {file_path}")
+        submit_file(state["url"], file_path, state.get("total_size", 0))
+
+
+def next_job() -> dict | None:
+    """
+    Picks the next job allowed to start. Must be called holding _cond.
+
+    return: job:dict or None
+    """
+    concurrency, per_host = get_limits()
+
+    running = [job for job in _jobs if job["status"] == RUNNING]
+    if len(running) >= concurrency:
+        return None
+
+    hosts = {}
+    for job in running:
+        hosts[job["host"]] = hosts.get(job["host"], 0) + 1
+
+    queued = []
+    for job in _jobs:
+        if job["status"] != QUEUED:
+            continue
+
+        if job["priority"] <= PRIORITY_BATCH and bandwidth.must_wait(job.get("size", 0)):
+            job["message"] = "Waiting for off-peak hours"
+            continue
+
+        if hosts.get(job["host"], 0) < per_host:
+            queued.append(job)
+
+    if not queued:
+        return None
+
+    return min(queued, key=lambda job: (-job["priority"], job["seq"]))
+
+
+def schedule() -> None:
+    """ Starts queued jobs as the limits allow, forever """
+    recover()
+
+    while True:
+        with _cond:
+            job = next_job()
+            while not job:
+                # also wakes up now and then for changed limits and off-peak hours
+                _cond.wait(timeout=5)
+                job = next_job()
+
+            job["status"] = RUNNING
+            job["message"] = "Starting download"
+            save_queue()
+
+        threading.Thread(target=run_job, args=(job,), daemon=True).start()
+
+
+def start() -> None:
+    """ Starts the scheduler, resuming any interrupted downloads """
+    global _scheduler
+
+    with _cond:
+        if _scheduler:
+            return
+
+        _scheduler = threading.Thread(target=schedule, daemon=True)
+        _scheduler.start()
+
+
+def run_job(job:dict) -> None:
+    """ Runs a download job, recording its progress and result """
+    downloader.set_job(job["id"])
+
+    status = FAILED
+    message = ""
+    try:
+        if job["kind"] == "model":
+            status, message = run_model_job(job)
+        else:
+            status, message = run_file_job(job)
+
+    except Exception as e:
+        message = f"An error has occurred while downloading: {e}"
+        util.printD(message)
+
+    finally:
+        downloader.set_job(None)
+
+        with _cond:
+            job["status"] = status
+            job["message"] = message
+            save_queue()
+            _cond.notify_all()
+
+
+def run_model_job(job:dict) -> tuple[str, str]:
+    """ return: (status, message) """
+    model_info = civitai.get_model_info_by_id(job["model_id"])
+    if not model_info:
+        return (FAILED, f"Failed to get model info for model {job['model_id']}")
+
+    message = ""
+    for message in model_action_civitai.dl_model_by_input(
+        {"model_info": model_info},
+        job["model_type"],
+        job["subfolder"],
+        job["version_str"],
+        job["filename"],
+        job["file_ext"],
+        job["dl_all"],
+        job["duplicate"],
+        job["preview"],
+        *job["filetypes"]
+    ):
+        job["message"] = message
+
+    if message.startswith("Done."):
+        return (DONE, message)
+
+    return (FAILED, message)
+
+
+def run_file_job(job:dict) -> tuple[str, str]:
+    """ return: (status, message) """
+    for result in downloader.dl_file(
+        job["url"],
+        file_path=job["file_path"],
+        headers=civitai.get_download_headers()
+    ):
+        if isinstance(result, str):
+            job["message"] = result
+            continue
+
+        success, output = result
+        if success:
+            return (DONE, f"Done. Downloaded to: {output}")
+
+        return (FAILED, output)
+
+    return (FAILED, "Download did not complete")
+
+
+def get_jobs(job_ids:list[str] | None=None) -> list[dict]:
+    """
+    job_ids: jobs to return, or every job if None
+
+    return: copies of the jobs, in queue order
+    """
+    with _cond:
+        load_queue()
+
+        return [
+            dict(job) for job in sorted(_jobs, key=lambda job: job["seq"])
+            if job_ids is None or job["id"] in job_ids
+        ]
+
+
+def format_status(jobs:list[dict]) -> str:
+    """ return: markdown status of jobs """
+    if not jobs:
+        return "The download queue is empty."
+
+    lines = [
+        f"{job['name']} [{job['status']}]: {job['message']}"
+        for job in jobs
+    ]
+    lines = "\n".join(lines)
+
+    return f"```\n{lines}\n```"
+
+
+def follow(job_ids:list[str]):
+    """
+    Reports the status of jobs until all of them are finished.
+    Leaving early does not stop the downloads.
+
+    yields: status markdown
+    """
+    last = None
+    while True:
+        jobs = get_jobs(job_ids)
+        status = format_status(jobs)
+        if status != last:
+            last = status
+            yield status
+
+        if all(job["status"] in FINISHED for job in jobs):
+            return
+
+        time.sleep(STATUS_SECONDS)
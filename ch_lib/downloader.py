@@ -3,43 +3,329 @@ Used for downloading files
 """
 from __future__ import annotations
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor, wait
+import datetime
+import email.utils
 import os
 import platform
+import random
+import re
+import threading
 import time
+import urllib.parse
 from typing import cast, Literal
 from tqdm import tqdm
 import requests
 import urllib3
 from . import util
+from . import model
+from . import inventory
+from . import json_codec
+from . import bandwidth
+from . import rate_limit
 
 
 DL_EXT = ".downloading"
-MAX_RETRIES = 30
+DL_STATE_EXT = ".downloading.json"
+
+# segmented downloads
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024  # 32 MiB
+SEGMENT_CHUNK_SIZE = 256 * 1024
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024  # 4 MiB, a whole number of disk blocks
+READ_SIZE = 256 * 1024
+# how often the progress of a download is saved
+STATE_SAVE_SECONDS = 30
+STATE_SAVE_BYTES = 64 * 1024 * 1024  # 64 MiB
+
+# retry policy for failed requests
+MAX_RETRIES = 8
+BACKOFF_BASE = 2  # seconds
+BACKOFF_MAX = 240  # seconds
+RETRY_STATUS_CODES = (408, 425, 429)
+
+# failure of a segment that means the server can not download in segments
+SEGMENTS_UNSUPPORTED = "Server does not support downloading in segments."
+
+# consecutive failures before requests to a host fail fast, and for how long
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60  # seconds
 
 # disable ssl warning info
 urllib3.disable_warnings()
 
+# One session is shared by every thread. The session and its connection
+# pools are safe to share for plain requests like these, and a session per
+# thread would keep the sockets of every short-lived worker open.
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+# download manager job the current thread is running, saved with the
+# progress of its downloads so it can resume them after a restart
+_job_local = threading.local()
+
+
+def get_pool_size() -> int:
+    """
+    return: connections kept alive per host, enough for every segment
+    of every download and every API worker at once
+    """
+    concurrency = max(int(util.get_opts("ch_dl_concurrency") or 1), 1)
+    segments = max(int(util.get_opts("ch_dl_segments") or 1), 1)
+
+    return concurrency * segments + rate_limit.get_workers() + model.EXAMPLE_WORKERS
+
+
+def get_session() -> requests.Session:
+    """
+    Gets the shared HTTP session, which keeps connections alive
+    between requests instead of opening a new connection for each one.
+    A new session is made when the settings need a larger pool.
+
+    return: requests.Session
+    """
+    global _session, _session_pool_size
+
+    pool_size = get_pool_size()
+
+    with _session_lock:
+        if _session is not None and _session_pool_size == pool_size:
+            return _session
+
+        # requests still using the old session finish with it
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        _session = session
+        _session_pool_size = pool_size
+
+    return session
+
+
+def close_session() -> None:
+    """
+    Closes all pooled connections, e.g. after the proxy has changed.
+    A new session is made on the next request.
+    """
+    global _session
+
+    with _session_lock:
+        session = _session
+        _session = None
+
+    if session is not None:
+        session.close()
+
+
+def set_job(job_id:str | None) -> None:
+    """ Records the download job the current thread is running """
+    _job_local.job_id = job_id
+
+
+def get_job() -> str | None:
+    """ return: id of the download job the current thread is running """
+    return getattr(_job_local, "job_id", None)
+
+
 def calculate_stepback_delay_seconds(
-    retries: int
-) -> int:
+    retries: int,
+    retry_after: float | None=None
+) -> float:
     """
         calculate a delay to be used when Civitai
         is having network issues
 
-        TODO: maybe allow some degree of customization.
+        Uses exponential backoff with full jitter, so clients that failed
+        together do not all retry together. A Retry-After sent by the
+        server takes precedence when it asks for a longer wait, even
+        beyond BACKOFF_MAX, which only caps the jittered backoff.
     """
 
-    delay = 3 + ((retries >> 1)**2) # at 30 retries, ~4 minutes
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** retries)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
     return delay
 
 
+def parse_retry_after(value:str | None) -> float | None:
+    """
+    Parses a Retry-After header, which is either a number of seconds
+    or an HTTP date.
+
+    return: seconds:float or None
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at is None:
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((retry_at - now).total_seconds(), 0)
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures per host. Once BREAKER_THRESHOLD requests
+    in a row have failed, the circuit opens and new requests to that host
+    fail immediately for BREAKER_COOLDOWN seconds instead of each waiting
+    through their own retries. After the cooldown, requests are let
+    through again and the first success closes the circuit.
+    """
+
+    def __init__(self, threshold:int, cooldown:float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def remaining(self, host:str) -> float:
+        """ return: seconds until the circuit for host closes, 0 if it is closed """
+        with self.lock:
+            return self._remaining(host)
+
+    def _remaining(self, host:str) -> float:
+        opened = self.opened.get(host, None)
+        if opened is None:
+            return 0
+
+        return max(opened + self.cooldown - time.monotonic(), 0)
+
+    def success(self, host:str) -> None:
+        """ Records a successful request """
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, host:str) -> None:
+        """ Records a failed request, opening the circuit if there were too many """
+        with self.lock:
+            failures = self.failures.get(host, 0) + 1
+            self.failures[host] = failures
+
+            if failures >= self.threshold:
+                if not self._remaining(host):
+                    util.printD(f"{host} appears to be down, pausing requests for {self.cooldown} seconds")
+                self.opened[host] = time.monotonic()
+
+
+_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+
 def request_get(
     url:str,
-    headers:dict | None=None,
-    retries=0
+    headers:dict | None=None
 ) -> tuple[Literal[True], requests.Response] | tuple[Literal[False], str]:
     """
-    Performs a GET request
+    Performs a GET request, retrying when the server or the connection fails
+
+    returns: tuple(success:bool, response:Response or failure message:str)
+    """
+
+    headers = util.append_default_headers(headers or {})
+    host = urllib.parse.urlparse(url).netloc
+
+    if _breaker.remaining(host):
+        output = f"{host} is not responding, skipping request for {url}"
+        util.printD(output)
+        return (False, output)
+
+    retries = 0
+    while True:
+        retry_after = None
+
+        try:
+            response = get_session().get(
+                url,
+                stream=True,
+                verify=False,
+                headers=headers,
+                proxies=util.PROXIES,
+                timeout=util.REQUEST_TIMEOUT
+            )
+
+        except (TimeoutError, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            reason = f"GET Request failed for {url}: {e}"
+            util.printD(reason)
+            _breaker.failure(host)
+
+        else:
+            if response.ok:
+                _breaker.success(host)
+                return (True, response)
+
+            status_code = response.status_code
+            reason = response.reason
+            retry_after = parse_retry_after(response.headers.get("Retry-After", None))
+            # return the connection to the pool
+            response.close()
+
+            util.printD(util.indented_msg(
+                f"""
+                GET Request failed with error code:
+                {status_code}: {reason}
+                """
+            ))
+
+            if status_code == 401:
+                return (
+                    False,
+                    "This download requires Authentication. Please add an API Key to Civitai Helper's settings to continue this download. See [Wiki](https://github.com/zixaphir/Stable-Diffusion-Webui-Civitai-Helper/wiki/Civitai-API-Key) for details on how to create an API Key."
+                )
+
+            if status_code == 416:
+                response.raise_for_status()
+
+            if status_code not in RETRY_STATUS_CODES and status_code < 500:
+                # the request itself was refused, retrying will not help
+                return (False, reason)
+
+            if status_code != 429:
+                # being rate limited does not mean the server is down
+                _breaker.failure(host)
+
+        if retries >= MAX_RETRIES:
+            return (False, reason)
+
+        # Step-back delay to allow for website to recover. If the circuit
+        # opened meanwhile, this request keeps probing while others fail fast.
+        retry_delay = max(
+            calculate_stepback_delay_seconds(retries, retry_after),
+            _breaker.remaining(host)
+        )
+        util.printD(f"Retrying after {retry_delay:.1f} seconds")
+        time.sleep(retry_delay)
+
+        retries = retries + 1
+
+
+def request_post(
+    url:str,
+    json_data,
+    headers:dict | None=None
+) -> tuple[Literal[True], requests.Response] | tuple[Literal[False], str]:
+    """
+    Performs a POST request with a JSON body. Unlike request_get,
+    failures are not retried, callers are expected to fall back to GET.
 
     returns: tuple(success:bool, response:Response or failure message:str)
     """
@@ -47,54 +333,29 @@ def request_get(
     headers = util.append_default_headers(headers or {})
 
     try:
-        response = requests.get(
+        response = get_session().post(
             url,
-            stream=True,
+            json=json_data,
             verify=False,
             headers=headers,
             proxies=util.PROXIES,
             timeout=util.REQUEST_TIMEOUT
         )
 
-    except TimeoutError:
-        output = f"GET Request timed out for {url}"
-        print(output)
+    except (TimeoutError, requests.exceptions.RequestException) as e:
+        output = f"POST Request failed for {url}: {e}"
+        util.printD(output)
         return (False, output)
 
     if not response.ok:
-        status_code = response.status_code
-        reason = response.reason
         util.printD(util.indented_msg(
             f"""
-            GET Request failed with error code:
-            {status_code}: {reason}
+            POST Request failed with error code:
+            {response.status_code}: {response.reason}
             """
         ))
-
-        if status_code == 401:
-            return (
-                False,
-                "This download requires Authentication. Please add an API Key to Civitai Helper's settings to continue this download. See [Wiki](https://github.com/zixaphir/Stable-Diffusion-Webui-Civitai-Helper/wiki/Civitai-API-Key) for details on how to create an API Key."
-            )
-
-        if status_code == 416:
-            response.raise_for_status()
-
-        if status_code != 404 and retries < MAX_RETRIES:
-            retry_delay = calculate_stepback_delay_seconds(retries)
-            util.printD(f"Retrying after {retry_delay} seconds")
-
-            # Step-back delay to allow for website to recover
-            time.sleep(retry_delay)
-
-            # recursive retry
-            return request_get(
-                url,
-                headers,
-                retries + 1
-            )
-
-        return (False, reason)
+        response.close()
+        return (False, response.reason)
 
     return (True, response)
 
@@ -125,11 +386,20 @@ def download_progress(
     file_path:str,
     total_size:int,
     headers:dict | None=None,
-    response_without_range:requests.Response | None=None
+    response_without_range:requests.Response | None=None,
+    sha256:str | None=None
 ) -> Generator[tuple[bool, str] | str, None, None]:
     """
     Performs a file download.
 
+    Model files are hashed as they are streamed to disk. If `sha256` is given,
+    the result is verified against it. The hashes are added to the hash cache
+    so the model never needs to be read again just to be hashed.
+
+    Model files, and every file downloaded by a download manager job, are
+    preallocated at their full size and their progress is saved next to
+    them, so they can be resumed after a restart.
+
     yields: tuple(success:bool, filepath or failure message:str) or progress:str
     """
     # use a temp file for downloading
@@ -141,10 +411,17 @@ def download_progress(
 
     util.printD(f"Downloading to temp file: {dl_path}")
 
+    track = bool(get_job()) or os.path.splitext(file_path)[1] in model.EXTS
+    state = {
+        "url": url,
+        "total_size": total_size,
+        "job": get_job(),
+        "written": 0,
+    }
+
     # check if downloading file exists
-    downloaded_size = 0
-    if os.path.exists(dl_path):
-        downloaded_size = os.path.getsize(dl_path)
+    downloaded_size = get_resume_offset(file_path, total_size)
+    if downloaded_size:
         util.printD(f"Resuming partially downloaded file from progress: {downloaded_size}")
 
     # use response without range or create request with range
@@ -177,8 +454,10 @@ def download_progress(
             util.printD("Could not resume download from existing temporary file. Restarting download.")
 
             os.remove(dl_path)
+            if os.path.isfile(get_state_path(file_path)):
+                os.remove(get_state_path(file_path))
 
-            yield from download_progress(url, file_path, total_size, headers)
+            yield from download_progress(url, file_path, total_size, headers, sha256=sha256)
             return
 
         if not success:
@@ -187,33 +466,74 @@ def download_progress(
 
         response = cast(requests.Response, response_or_error)
 
+        if downloaded_size and response.status_code != 206:
+            # server ignored the Range header and is sending the whole file
+            util.printD("Server does not support resuming downloads. Restarting download.")
+            downloaded_size = 0
+
+    digests = None
+    if os.path.splitext(file_path)[1] in model.EXTS:
+        digests = util.FileDigests(
+            autov3=file_path.endswith(".safetensors"),
+            extra=util.get_opts("ch_extra_hashes")
+        )
+
+        if downloaded_size:
+            # hash the partial download once, then continue with the stream
+            with open(dl_path, "rb", buffering=0) as partial_file:
+                remaining = downloaded_size
+                for block in util.read_into_chunks(partial_file, bytearray(util.HASH_BLOCK_MAX)):
+                    block = block[:remaining]
+                    digests.update(block)
+                    remaining = remaining - len(block)
+                    if not remaining:
+                        break
+
     last_tick = 0
     start = time.time()
+    last_save = start
+    last_save_size = downloaded_size
 
     downloaded_this_session = 0
 
     # write to file
-    with open(dl_path, 'ab') as target, tqdm(
-        initial=target.tell(),
+    mode = "r+b" if os.path.exists(dl_path) else "w+b"
+    with open(dl_path, mode) as target, tqdm(
+        initial=downloaded_size,
         total=total_size,
         unit='iB',
         unit_scale=True,
         unit_divisor=1024
     ) as progress_bar:
-        for chunk in response.iter_content(chunk_size=256*1024):
-            if chunk:
-                downloaded_this_session += len(chunk)
-                downloaded_size += len(chunk)
-                written = target.write(chunk)
+        if not downloaded_size:
+            target.truncate(0)
+            if track:
+                preallocate(target, total_size)
+
+        target.seek(downloaded_size)
 
-                # write to disk
-                target.flush()
+        try:
+            for block in read_response_blocks(response, bytearray(WRITE_BLOCK_SIZE), downloaded_size):
+                written = target.write(block)
+                downloaded_this_session += written
+                downloaded_size += written
+
+                if digests:
+                    digests.update(block)
 
                 progress_bar.update(written)
 
                 percent = int(100 * (downloaded_size / total_size))
                 timer = time.time()
 
+                if track and (
+                    timer - last_save > STATE_SAVE_SECONDS
+                    or downloaded_size - last_save_size >= STATE_SAVE_BYTES
+                ):
+                    last_save = timer
+                    last_save_size = downloaded_size
+                    save_stream_state(file_path, state, target, downloaded_size)
+
                 # Gradio output is a *slooowwwwwwww* asynchronous FIFO queue
                 if timer - last_tick > 0.2 or percent == 100:
 
@@ -232,6 +552,36 @@ def download_progress(
 
                     yield text_progress
 
+        finally:
+            # also reached when the download is abandoned part way through
+            if track:
+                save_stream_state(file_path, state, target, downloaded_size)
+
+        # drop preallocated space the stream did not fill
+        target.truncate(downloaded_size)
+
+        # written once, instead of flushing every block
+        sync_data(target)
+
+    yield from finish_download(url, file_path, total_size, digests, sha256)
+
+
+def finish_download(
+    url:str,
+    file_path:str,
+    total_size:int,
+    digests:util.FileDigests | None,
+    sha256:str | None=None
+) -> Generator[tuple[bool, str], None, None]:
+    """
+    Checks a completed temporary download, moves it into place and records
+    the hashes computed while downloading. A download that does not match
+    `sha256` is deleted instead.
+
+    yields: tuple(success:bool, filepath or failure message:str)
+    """
+    dl_path = f"{file_path}{DL_EXT}"
+
     # check file size
     downloaded_size = os.path.getsize(dl_path)
     if downloaded_size != total_size:
@@ -246,14 +596,413 @@ def download_progress(
         util.warning(warning)
         util.printD(warning)
 
+    file_hashes = digests.hexdigests() if digests else None
+    state_path = get_state_path(file_path)
+
+    if file_hashes and sha256 and file_hashes["sha256"] != sha256.lower():
+        # a corrupt model is worse than no model, so it is not kept
+        os.remove(dl_path)
+        if os.path.isfile(state_path):
+            os.remove(state_path)
+
+        warning = util.indented_msg(
+            f"""
+            File hash does not match Civitai: {file_path}.
+            Expected {sha256.lower()}, got {file_hashes["sha256"]}.
+            The download has been deleted. Please try again later
+            or download the file manually: {url}
+            """
+        )
+        util.warning(warning)
+        util.printD(warning)
+
+        yield (False, f"File hash does not match Civitai: {file_path}")
+        return
+
     # rename file
     os.rename(dl_path, file_path)
+
+    if os.path.isfile(state_path):
+        os.remove(state_path)
+
     output = f"File Downloaded to: {file_path}"
     util.printD(output)
 
+    if file_hashes:
+        inventory.update_model(file_path)
+        util.cache_file_hashes(file_path, file_hashes)
+
     yield (True, file_path)
 
 
+def get_state_path(file_path:str) -> str:
+    """ return: path of the file recording the progress of a download """
+    return f"{file_path}{DL_STATE_EXT}"
+
+
+def sync_data(target) -> None:
+    """ Flushes a file and waits until its data is on disk """
+    target.flush()
+    getattr(os, "fdatasync", os.fsync)(target.fileno())
+
+
+def save_stream_state(file_path:str, state:dict, target, written:int) -> None:
+    """
+    Saves the progress of a single stream download, without waiting for
+    the disk. Written data survives the webui being closed, and only a
+    system crash can lose the last blocks, which the hash check when the
+    download finishes catches for model files.
+    """
+    target.flush()
+    state["written"] = written
+    util.write_json_atomic(get_state_path(file_path), state, durable=False)
+
+
+def get_resume_offset(file_path:str, total_size:int) -> int:
+    """
+    Finds how much of a single stream download is already on disk.
+    Preallocated files are as large as the whole download, so their
+    progress comes from the saved state instead of the file size.
+
+    return: number of bytes to resume from
+    """
+    dl_path = f"{file_path}{DL_EXT}"
+    if not os.path.exists(dl_path):
+        return 0
+
+    size = os.path.getsize(dl_path)
+
+    try:
+        state = json_codec.load_file(get_state_path(file_path))
+    except (OSError, ValueError):
+        # written without preallocation
+        return size
+
+    if "written" not in state:
+        return size
+
+    if state.get("total_size", None) != total_size:
+        util.printD("Saved download progress does not match the file. Restarting download.")
+        return 0
+
+    return min(state["written"], size)
+
+
+def preallocate(target, size:int) -> None:
+    """
+    Reserves disk space for a whole download up front, so the filesystem
+    can keep the file in as few extents as possible. Where posix_fallocate
+    is not available, the file is only extended to its final size.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(target.fileno(), 0, size)
+            return
+        except OSError as e:
+            util.printD(f"Could not preallocate download, extending it instead: {e}")
+
+    target.truncate(size)
+
+
+def read_response_blocks(
+    response:requests.Response,
+    buffer:bytearray,
+    offset:int=0
+) -> Generator[memoryview, None, None]:
+    """
+    Reads a response body straight into `buffer`, yielding it only once
+    it is full, so the file is written in blocks of the buffer size that
+    line up with the start of the file, even when resuming from `offset`.
+    Reads are kept small enough for the bandwidth limit to pace them evenly.
+
+    Each yielded memoryview is only valid until the next iteration.
+    """
+    view = memoryview(buffer)
+    response.raw.decode_content = True
+
+    blocksize = len(buffer) - offset % len(buffer)
+    filled = 0
+
+    while True:
+        read = response.raw.readinto(view[filled:min(filled + READ_SIZE, blocksize)])
+        if not read:
+            break
+
+        bandwidth.throttle(read)
+
+        filled = filled + read
+        if filled == blocksize:
+            yield view[:filled]
+            filled = 0
+            blocksize = len(buffer)
+
+    if filled:
+        yield view[:filled]
+
+
+def load_download_state(file_path:str, total_size:int) -> dict | None:
+    """
+    Loads the saved progress of a segmented download.
+
+    return: state:dict or None if there is no usable segmented state
+    """
+    state_path = get_state_path(file_path)
+    if not (os.path.isfile(state_path) and os.path.isfile(f"{file_path}{DL_EXT}")):
+        return None
+
+    try:
+        state = json_codec.load_file(state_path)
+    except (OSError, ValueError):
+        return None
+
+    if not state.get("segments", None):
+        # progress of a single stream download, which resumes from the file size
+        return None
+
+    if state.get("total_size", None) != total_size:
+        # the partial file is not a plain prefix, so it can not be resumed otherwise
+        util.printD("Saved download progress does not match the file. Restarting download.")
+        os.remove(f"{file_path}{DL_EXT}")
+        os.remove(state_path)
+        return None
+
+    return state
+
+
+def save_download_state(file_path:str, state:dict, lock:threading.Lock) -> None:
+    """
+    Saves the progress of a segmented download. The data file is synced
+    first, so the saved progress never counts bytes that are not on disk.
+    """
+    with lock:
+        data = {**state, "segments": [dict(segment) for segment in state["segments"]]}
+
+    with open(f"{file_path}{DL_EXT}", "r+b") as target:
+        sync_data(target)
+
+    util.write_json_atomic(get_state_path(file_path), data)
+
+
+def plan_segments(total_size:int, count:int) -> list[dict]:
+    """
+    Splits a file into `count` byte ranges, no smaller than SEGMENT_MIN_SIZE.
+
+    return: list of segments {"start": int, "end": int, "done": int},
+        end inclusive, done counting bytes written from start.
+    """
+    count = max(min(count, total_size // SEGMENT_MIN_SIZE), 1)
+    size = -(-total_size // count)
+
+    return [
+        {"start": start, "end": min(start + size, total_size) - 1, "done": 0}
+        for start in range(0, total_size, size)
+    ]
+
+
+def is_expected_range(response:requests.Response, start:int, end:int) -> bool:
+    """ return: True if the response holds exactly the requested byte range """
+    if response.status_code != 206:
+        return False
+
+    match = re.match(r"bytes (\d+)-(\d+)/", response.headers.get("Content-Range", ""))
+
+    return bool(match) and (int(match.group(1)), int(match.group(2))) == (start, end)
+
+
+def download_segment(
+    url:str,
+    headers:dict,
+    dl_path:str,
+    segment:dict,
+    lock:threading.Lock,
+    cancel:threading.Event
+) -> str | None:
+    """
+    Downloads one byte range of a file into its place in `dl_path`,
+    continuing from where the segment left off.
+
+    return: None on success, otherwise a failure message
+    """
+    length = segment["end"] - segment["start"] + 1
+    retries = 0
+
+    while segment["done"] < length and not cancel.is_set():
+        pos = segment["start"] + segment["done"]
+        range_headers = {**headers, "Range": f"bytes={pos}-{segment['end']}"}
+
+        try:
+            success, response_or_error = request_get(url, headers=range_headers)
+        except requests.exceptions.HTTPError as dl_error:
+            return f"Range request failed: {dl_error}"
+
+        if not success:
+            return cast(str, response_or_error)
+
+        response = cast(requests.Response, response_or_error)
+
+        try:
+            # unbuffered, so bytes counted as done have reached the OS
+            with response, open(dl_path, "r+b", buffering=0) as target:
+                if not is_expected_range(response, pos, segment["end"]):
+                    return SEGMENTS_UNSUPPORTED
+
+                target.seek(pos)
+                for chunk in response.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                    if cancel.is_set():
+                        return None
+
+                    # never write past the end of the segment
+                    chunk = chunk[:length - segment["done"]]
+                    if not chunk:
+                        break
+
+                    written = target.write(chunk)
+                    bandwidth.throttle(written)
+                    with lock:
+                        segment["done"] = segment["done"] + written
+
+        except (requests.exceptions.RequestException, ConnectionError) as e:
+            reason = f"{e}"
+
+        else:
+            if segment["done"] >= length or cancel.is_set():
+                continue
+
+            reason = "the response ended before the end of the segment"
+
+        # the connection dropped or the response was short,
+        # resume from what was written
+        if retries >= MAX_RETRIES:
+            return f"Segment download failed: {reason}"
+
+        retries = retries + 1
+        retry_delay = calculate_stepback_delay_seconds(retries)
+        util.printD(f"Segment download interrupted, retrying after {retry_delay:.1f} seconds: {reason}")
+        cancel.wait(retry_delay)
+
+    return None
+
+
+def segmented_download(
+    url:str,
+    file_path:str,
+    total_size:int,
+    headers:dict | None=None,
+    sha256:str | None=None,
+    segment_count:int=1
+) -> Generator[tuple[bool, str] | str, None, None]:
+    """
+    Downloads a file over several connections at once, each fetching its
+    own byte range into a preallocated temporary file. Progress of every
+    segment is saved next to the file, so an interrupted download resumes
+    all segments.
+
+    yields: tuple(success:bool, filepath or failure message:str) or progress:str
+    """
+    headers = headers or {}
+    dl_path = f"{file_path}{DL_EXT}"
+
+    state = load_download_state(file_path, total_size)
+    if state:
+        util.printD(f"Resuming segmented download: {dl_path}")
+        state["job"] = get_job()
+    else:
+        state = {
+            "url": url,
+            "total_size": total_size,
+            "job": get_job(),
+            "segments": plan_segments(total_size, segment_count),
+        }
+
+        with open(dl_path, "wb") as target:
+            preallocate(target, total_size)
+
+    segments = state["segments"]
+    lock = threading.Lock()
+    cancel = threading.Event()
+    save_download_state(file_path, state, lock)
+
+    util.printD(f"Downloading in {len(segments)} segments to temp file: {dl_path}")
+
+    def downloaded():
+        with lock:
+            return sum(segment["done"] for segment in segments)
+
+    initial_size = downloaded()
+    start = time.time()
+    last_save = start
+    errors = []
+
+    executor = ThreadPoolExecutor(max_workers=len(segments))
+    try:
+        futures = [
+            executor.submit(download_segment, url, headers, dl_path, segment, lock, cancel)
+            for segment in segments
+        ]
+
+        pending = futures
+        while pending:
+            done, pending = wait(pending, timeout=0.2)
+            errors.extend(future.result() for future in done if future.result())
+
+            if errors:
+                break
+
+            timer = time.time()
+            if timer - last_save > STATE_SAVE_SECONDS:
+                last_save = timer
+                save_download_state(file_path, state, lock)
+
+            downloaded_size = downloaded()
+            elapsed = timer - start
+            downloaded_this_session = downloaded_size - initial_size
+            speed = downloaded_this_session // elapsed if elapsed >= 1 \
+                else downloaded_this_session
+
+            yield visualize_progress(
+                int(100 * (downloaded_size / total_size)),
+                downloaded_size,
+                total_size,
+                speed,
+                False
+            )
+
+    finally:
+        # also reached when the download is abandoned part way through
+        cancel.set()
+        executor.shutdown(wait=True)
+        # also syncs the completed file
+        save_download_state(file_path, state, lock)
+
+    if SEGMENTS_UNSUPPORTED in errors:
+        # the saved segments would send every retry down the same path
+        util.printD(f"{SEGMENTS_UNSUPPORTED} Restarting download as a single stream.")
+        os.remove(dl_path)
+        os.remove(get_state_path(file_path))
+
+        yield from download_progress(url, file_path, total_size, headers, sha256=sha256)
+        return
+
+    if errors:
+        util.printD(f"Segmented download failed: {errors[0]}")
+        yield (False, errors[0])
+        return
+
+    digests = None
+    if os.path.splitext(file_path)[1] in model.EXTS:
+        # segments arrive out of order, so the file is hashed once complete
+        digests = util.FileDigests(
+            autov3=file_path.endswith(".safetensors"),
+            extra=util.get_opts("ch_extra_hashes")
+        )
+
+        with open(dl_path, "rb", buffering=0) as complete_file:
+            for percent, _ in util.calculate_hashes(complete_file, digests):
+                yield f"Hashing downloaded file: {int(percent * 100)}%"
+
+    yield from finish_download(url, file_path, total_size, digests, sha256)
+
+
 def get_file_path_from_service_headers(response:requests.Response, folder:str) -> str | None:
     """
     Parses a response header to get a filename
@@ -288,11 +1037,14 @@ def dl_file(
     filename:str | None=None,
     file_path:str | None=None,
     headers:dict | None=None,
-    duplicate:str | None=None
+    duplicate:str | None=None,
+    sha256:str | None=None
 ) -> Generator[tuple[bool, str] | str, None, None]:
     """
     Perform a download.
 
+    sha256: expected hash of the file, as listed by Civitai
+
     yields: tuple(success:bool, filepath or failure message:str) or progress:str
     """
 
@@ -369,7 +1121,19 @@ def dl_file(
 
         util.printD(f"File size: {total_size} ({human_readable_filesize(total_size)})")
 
-        yield from download_progress(url, file_path, total_size, headers, response)
+        segment_count = int(util.get_opts("ch_dl_segments") or 1)
+        if load_download_state(file_path, total_size) or (
+            segment_count > 1
+            and total_size >= SEGMENT_MIN_SIZE * 2
+            and response.headers.get("Accept-Ranges", "") == "bytes"
+            and not os.path.exists(f"{file_path}{DL_EXT}")
+        ):
+            # segments are fetched with their own range requests
+            response.close()
+            yield from segmented_download(url, file_path, total_size, headers, sha256, segment_count)
+            return
+
+        yield from download_progress(url, file_path, total_size, headers, response, sha256)
 
 
 def human_readable_filesize(size:int | float) -> str:
@@ -4,13 +4,15 @@ Check for duplicate models.
 
 import os
 import html
-import json
 import traceback
 import gradio as gr
 from . import util
+from . import json_codec
 from . import model
 from . import civitai
 from . import templates
+from . import hash_cache
+from . import inventory
 
 
 def scan_for_dups(scan_model_types, cached_hash, progress=gr.Progress()):
@@ -42,6 +44,8 @@ def scan_for_dups(scan_model_types, cached_hash, progress=gr.Progress()):
             progress(percent, desc=status)
     models = result
 
+    hash_cache.flush()
+
     dups = check_for_dups(models)
 
     output = create_dups_html(dups)
@@ -71,25 +75,23 @@ def scan_dir(model_folder, model_type, cached_hash):
     """
 
     suffix = f"{civitai.SUFFIX}{model.CIVITAI_EXT}"
-    suffix_len = -len(suffix)
 
     metadata = []
     util.printD(f"Scanning path: {model_folder}")
-    for root, _, files in os.walk(model_folder, followlinks=True):
-        for filename in files:
-            try:
-                if filename[suffix_len:] == suffix:
-                    for result in parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash):
-                        yield result
-                    data = result
-                    if data:
-                        metadata.append(data)
-
-            except (IndexError, KeyError, ValueError):
-                util.printD(f"Error occurred on file `{root}/{filename}`")
-                traceback.print_exc()
-                util.printD("You can probably ignore this")
-                continue
+    for info_file in inventory.get_info_files(model_folder, force_refresh=True):
+        root, filename = os.path.split(info_file)
+        try:
+            for result in parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash):
+                yield result
+            data = result
+            if data:
+                metadata.append(data)
+
+        except (IndexError, KeyError, ValueError):
+            util.printD(f"Error occurred on file `{root}/{filename}`")
+            traceback.print_exc()
+            util.printD("You can probably ignore this")
+            continue
 
     yield metadata
 
@@ -104,12 +106,11 @@ def parse_metadata(model_folder, root, filename, suffix, model_type, cached_hash
 
     util.printD(f"Processing {model_name}")
 
-    with open(filepath) as file:
-        try:
-            model_info = json.load(file)
-        except json.JSONDecodeError:
-            yield None
-            return
+    try:
+        model_info = json_codec.load_file(filepath)
+    except ValueError:
+        yield None
+        return
 
     model_file = model_info["files"][0]
     model_ext = model_file["name"].split(".").pop()
@@ -0,0 +1,218 @@
+""" -*- coding: UTF-8 -*-
+Persistent hash cache keyed by file identity.
+
+webui keys its hash cache by `{type}/{basename}`, so renaming or moving a
+model means hashing it again. This cache keys hashes by
+(device, inode, size, mtime_ns) instead, which survives renames, moves
+within a filesystem and hardlinks. A path alias table records which
+identity each known path last had.
+
+Writes are batched: new entries are flushed to disk once FLUSH_COUNT of
+them are pending, FLUSH_SECONDS after the first pending entry, at the end
+of a scan, or at exit. The same applies to webui's hash cache.
+"""
+from __future__ import annotations
+import atexit
+import os
+import threading
+from . import util
+from . import json_codec
+
+CACHE_FILE = "hashes.json"
+
+FLUSH_COUNT = 100
+FLUSH_SECONDS = 30
+
+_lock = threading.Lock()
+
+# write-behind state
+_pending = 0
+_webui_pending = False
+_flush_timer = None
+
+# {"entries": {identity: {hash_name: hex}}, "aliases": {path: identity}}
+_cache = None
+
+
+def file_identity(path:str) -> str | None:
+    """
+    return: identity:str for a file, or None if it can not be identified
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    # some filesystems do not provide inode numbers
+    if not stat.st_ino:
+        return None
+
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_cache_path() -> str:
+    """ return: path to the cache file """
+    return os.path.join(util.get_cache_dir(), CACHE_FILE)
+
+
+def load_cache() -> dict:
+    """ Loads the cache from disk on first use """
+    global _cache
+
+    if _cache is not None:
+        return _cache
+
+    _cache = {"entries": {}, "aliases": {}}
+
+    path = get_cache_path()
+    if not os.path.isfile(path):
+        return _cache
+
+    try:
+        data = json_codec.load_file(path)
+
+        _cache["entries"] = data.get("entries", {})
+        _cache["aliases"] = data.get("aliases", {})
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not load hash cache, starting a new one: {e}")
+
+    return _cache
+
+
+def save_cache() -> None:
+    """ Writes the cache to disk, dropping entries no path refers to """
+    with _lock:
+        cache = load_cache()
+
+        referenced = set(cache["aliases"].values())
+        cache["entries"] = {
+            identity: digests for identity, digests in cache["entries"].items()
+            if identity in referenced
+        }
+
+        util.write_json_atomic(get_cache_path(), cache)
+
+
+def mark_dirty(count=1, webui=False) -> None:
+    """
+    Records pending cache changes and flushes them when a threshold is met.
+    webui: webui's hash cache also has pending changes.
+    """
+    global _pending, _webui_pending, _flush_timer
+
+    with _lock:
+        _pending = _pending + count
+        _webui_pending = _webui_pending or webui
+        flush_now = _pending >= FLUSH_COUNT
+
+        if not (flush_now or _flush_timer):
+            _flush_timer = threading.Timer(FLUSH_SECONDS, flush)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+    if flush_now:
+        flush()
+
+
+def flush() -> None:
+    """ Writes any pending changes to disk """
+    global _pending, _webui_pending, _flush_timer
+
+    with _lock:
+        pending = _pending
+        webui_pending = _webui_pending
+        _pending = 0
+        _webui_pending = False
+
+        if _flush_timer:
+            _flush_timer.cancel()
+            _flush_timer = None
+
+    if pending:
+        save_cache()
+
+    if webui_pending:
+        util.dump_webui_hash_cache()
+
+
+atexit.register(flush)
+
+
+def lookup(path:str) -> dict | None:
+    """
+    Finds cached hashes for a file, wherever it has been moved or renamed.
+
+    return: dict of hash name to hex digest, or None
+    """
+    identity = file_identity(path)
+    if identity is None:
+        return None
+
+    path = os.path.realpath(path)
+
+    with _lock:
+        cache = load_cache()
+        digests = cache["entries"].get(identity, None)
+        if digests is None:
+            return None
+
+        cache["aliases"][path] = identity
+
+    return dict(digests)
+
+
+def store(path:str, digests:dict, webui=False) -> None:
+    """
+    Adds hashes for a file to the cache
+    webui: the hashes were also added to webui's hash cache
+    """
+    identity = file_identity(path)
+    if identity is None:
+        return
+
+    path = os.path.realpath(path)
+
+    with _lock:
+        cache = load_cache()
+        entry = cache["entries"].setdefault(identity, {})
+        entry.update(digests)
+        cache["aliases"][path] = identity
+
+    mark_dirty(webui=webui)
+
+
+def move(old_path:str, new_path:str) -> None:
+    """ Updates the alias table after a file has been renamed or moved """
+    old_path = os.path.realpath(old_path)
+
+    with _lock:
+        cache = load_cache()
+        identity = cache["aliases"].pop(old_path, None)
+
+    if identity is None:
+        return
+
+    new_identity = file_identity(new_path)
+    if new_identity is None:
+        return
+
+    with _lock:
+        cache = load_cache()
+        if new_identity != identity and identity in cache["entries"]:
+            # cross-device move: the content is unchanged but the inode is not
+            cache["entries"][new_identity] = cache["entries"][identity]
+
+        cache["aliases"][os.path.realpath(new_path)] = new_identity
+
+    mark_dirty()
+
+
+def forget(path:str) -> None:
+    """ Removes a deleted file from the alias table """
+    with _lock:
+        cache = load_cache()
+        identity = cache["aliases"].pop(os.path.realpath(path), None)
+
+    if identity is not None:
+        mark_dirty()
@@ -0,0 +1,587 @@
+""" -*- coding: UTF-8 -*-
+Shared in-memory inventory of model files.
+
+Model folders are walked once with os.scandir and every caller that needs
+to list models, find a model by name or find metadata files queries this
+index instead of walking the folders again.
+
+The index is kept per directory and persisted to disk. A refresh only
+lists directories whose mtime changed since they were last scanned, so
+restarting webui does not mean walking the whole library again. On Linux,
+inotify can be used instead to track which directories changed.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from . import util
+from . import json_codec
+from . import model
+from . import civitai
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    # optional, Linux only
+    INotify = None
+
+INVENTORY_FILE = "inventory.json"
+INVENTORY_VERSION = 2
+
+PREVIEW_EXTS = ("png", "jpg", "jpeg", "webp", "gif")
+
+# downloader.DL_EXT, which can not be imported here
+PARTIAL_EXT = ".downloading"
+
+# Directory mtimes this close to the time a directory was scanned can not
+# be trusted, as the directory may have changed again within the timestamp
+# resolution of the filesystem.
+RACY_SECONDS = 2
+
+_lock = threading.Lock()
+
+# {folder: {"dirs": {directory: dir_index}}}
+#   dir_index: {
+#       "mtime_ns": int, "scanned": float, "subdirs": [path],
+#       "models": {path: record}, "info_files": [path], "partials": [path]
+#   }
+_index = None
+
+# {folder: {"models": {path: record}, "info_files": [path], "partials": [path], "dirs": [path]}}
+# merged views of _index, rebuilt after each refresh
+_views = {}
+
+_watcher = None
+
+
+def get_inventory_path() -> str:
+    """ return: path to the persisted inventory """
+    return os.path.join(util.get_cache_dir(), INVENTORY_FILE)
+
+
+def load_index() -> dict:
+    """ Loads the persisted inventory on first use """
+    global _index
+
+    if _index is not None:
+        return _index
+
+    _index = {}
+
+    path = get_inventory_path()
+    if not os.path.isfile(path):
+        return _index
+
+    try:
+        data = json_codec.load_file(path)
+
+        if data.get("version", None) == INVENTORY_VERSION:
+            _index = data.get("folders", {})
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not load model inventory, rebuilding it: {e}")
+
+    return _index
+
+
+def save_index() -> None:
+    """ Persists the inventory to disk """
+    with _lock:
+        data = {
+            "version": INVENTORY_VERSION,
+            "folders": load_index(),
+        }
+
+        try:
+            util.write_json_atomic(get_inventory_path(), data, durable=False)
+        except OSError as e:
+            util.printD(f"Could not save model inventory: {e}")
+
+
+def scan_dir(directory:str, stat:os.stat_result) -> dict | None:
+    """
+    Lists a single directory.
+
+    return: dict:dir_index or None if the directory can not be read
+    """
+    info_suffix = f"{civitai.SUFFIX}{model.CIVITAI_EXT}"
+
+    try:
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+    except OSError as e:
+        util.printD(f"Could not read directory {directory}: {e}")
+        return None
+
+    subdirs = []
+    files = []
+    names = set()
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                subdirs.append(os.path.normpath(entry.path))
+            elif entry.is_file():
+                files.append(entry)
+                names.add(entry.name)
+        except OSError:
+            continue
+
+    models = {}
+    info_files = []
+    partials = []
+    for entry in files:
+        path = os.path.normpath(entry.path)
+
+        if entry.name.endswith(info_suffix):
+            info_files.append(path)
+            continue
+
+        if entry.name.endswith(PARTIAL_EXT):
+            partials.append(path)
+            continue
+
+        base, ext = os.path.splitext(entry.name)
+        if ext not in model.EXTS:
+            continue
+
+        try:
+            file_stat = entry.stat()
+        except OSError:
+            continue
+
+        models[path] = make_record(path, base, file_stat, names)
+
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "scanned": time.time(),
+        "subdirs": subdirs,
+        "models": models,
+        "info_files": info_files,
+        "partials": partials,
+    }
+
+
+def scan_folder(folder:str, previous:dict | None=None, changed:set | None=None) -> dict:
+    """
+    Walks a model folder, following symlinks but not symlink loops.
+
+    Directories from `previous` are reused without being listed again
+    when their mtime has not changed. If `changed` is given, it is the set
+    of directories known to have changed, and every other directory in
+    `previous` is reused without even being checked.
+
+    return: dict:folder_index
+    """
+    previous_dirs = (previous or {}).get("dirs", {})
+    dirs = {}
+
+    searched = set()
+    pending = [os.path.normpath(folder)]
+    while pending:
+        directory = pending.pop()
+        dir_index = previous_dirs.get(directory, None)
+
+        if changed is not None and dir_index and directory not in changed:
+            # the directory watcher saw no changes, but a symlink loop
+            # must still end at the same depth as in a full scan
+            canonical_dir = os.path.realpath(directory)
+            if canonical_dir in searched:
+                continue
+            searched.add(canonical_dir)
+
+            dirs[directory] = dir_index
+            pending.extend(dir_index["subdirs"])
+            continue
+
+        try:
+            canonical_dir = os.path.realpath(directory, strict=True)
+            stat = os.stat(directory)
+        except OSError:
+            util.printD(f"Symlink loop or missing directory: {directory}")
+            continue
+
+        if canonical_dir in searched:
+            continue
+        searched.add(canonical_dir)
+
+        if not (dir_index and is_current(dir_index, stat)):
+            dir_index = scan_dir(directory, stat)
+            if dir_index is None:
+                continue
+
+        dirs[directory] = dir_index
+        pending.extend(dir_index["subdirs"])
+
+    return {"dirs": dirs}
+
+
+def is_current(dir_index:dict, stat:os.stat_result) -> bool:
+    """ return: True if the directory has not changed since it was listed """
+    return (
+        dir_index["mtime_ns"] == stat.st_mtime_ns
+        and dir_index["scanned"] - stat.st_mtime > RACY_SECONDS
+    )
+
+
+def make_record(path:str, base:str, stat:os.stat_result, names:set) -> dict:
+    """
+    Creates the record for a single model file.
+    names: filenames in the same directory, used to check for sidecar files
+
+    return: dict:record
+    """
+    return {
+        "path": path,
+        "name": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "info": f"{base}{civitai.SUFFIX}{model.CIVITAI_EXT}" in names,
+        "json": f"{base}{model.SDWEBUI_EXT}" in names,
+        "preview": any(
+            f"{base}.preview.{ext}" in names or f"{base}.{ext}" in names
+            for ext in PREVIEW_EXTS
+        ),
+        # [modelId, versionId], read from the info file on demand.
+        # False if the info file has no ids.
+        "info_ids": None,
+    }
+
+
+def make_view(folder_index:dict) -> dict:
+    """
+    Merges the per-directory index of a folder.
+
+    return: dict:folder_view
+    """
+    models = {}
+    info_files = []
+    partials = []
+    for dir_index in folder_index["dirs"].values():
+        models.update(dir_index["models"])
+        info_files.extend(dir_index["info_files"])
+        partials.extend(dir_index["partials"])
+
+    return {
+        "models": models,
+        "info_files": info_files,
+        "partials": partials,
+        "dirs": list(folder_index["dirs"].keys()),
+    }
+
+
+def refresh_folder(folder:str) -> dict:
+    """
+    Brings the index of a single folder up to date.
+
+    return: dict:folder_view
+    """
+    util.printD(f"Indexing path: {folder}")
+
+    with _lock:
+        previous = load_index().get(folder, None)
+
+    changed = None
+    if _watcher and previous:
+        changed = _watcher.pop_changed(folder)
+
+    folder_index = scan_folder(folder, previous, changed)
+    view = make_view(folder_index)
+
+    with _lock:
+        _index[folder] = folder_index
+        _views[folder] = view
+
+    if _watcher:
+        _watcher.watch(folder, folder_index["dirs"].keys())
+
+    if folder_index != previous:
+        save_index()
+
+    return view
+
+
+def refresh_directory(directory:str) -> dict | None:
+    """
+    Brings the index of a single directory up to date, listing it again
+    only if its mtime changed, without checking the rest of its folder.
+    New subdirectories are left for the next refresh of the folder.
+
+    return: dict:dir_index or None if the directory is not indexed
+    """
+    directory = os.path.normpath(directory)
+
+    with _lock:
+        folders = [
+            folder for folder, folder_index in load_index().items()
+            if directory in folder_index["dirs"]
+        ]
+        if not folders:
+            return None
+        dir_index = _index[folders[0]]["dirs"][directory]
+
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        return None
+
+    if is_current(dir_index, stat):
+        return dir_index
+
+    dir_index = scan_dir(directory, stat)
+    if dir_index is None:
+        return None
+
+    with _lock:
+        for folder in folders:
+            _index[folder]["dirs"][directory] = dir_index
+            if folder in _views:
+                _views[folder] = make_view(_index[folder])
+
+    save_index()
+
+    return dir_index
+
+
+def refresh(folders:list | None=None) -> None:
+    """ Brings the index up to date for the given folders, or every indexed folder """
+    if folders is None:
+        folders = list(load_index().keys())
+
+    for folder in folders:
+        if folder:
+            refresh_folder(folder)
+
+
+def get_folder(folder:str, force_refresh=False) -> dict:
+    """
+    Gets the index of a single folder, building it on first use.
+    force_refresh: bring the index up to date first, see refresh_folder
+
+    return: dict:folder_view
+    """
+    view = _views.get(folder, None)
+    if force_refresh or view is None:
+        view = refresh_folder(folder)
+
+    return view
+
+
+def get_model_folders(model_type:str, with_lycoris=False) -> list:
+    """
+    return: list of folders for a model type. Lycoris models are listed
+    with loras when `with_lycoris` is set.
+    """
+    model_folders = [model.folders[model_type]]
+    if with_lycoris and model_type == "lora" and model.folders["lycoris"]:
+        model_folders.append(model.folders["lycoris"])
+
+    return model_folders
+
+
+def get_models(model_type:str, with_lycoris=False, force_refresh=True) -> list:
+    """
+    Lists the models of a model type. The index is brought up to date
+    first by default, listing again only the directories whose mtime
+    changed, so model lists include files changed outside the extension.
+
+    return: list of model records of a model type
+    """
+    records = []
+    for folder in get_model_folders(model_type, with_lycoris):
+        records.extend(get_folder(folder, force_refresh)["models"].values())
+
+    return records
+
+
+def get_info_files(folder:str, force_refresh=False) -> list:
+    """
+    return: list of civitai info file paths in a folder
+    """
+    return list(get_folder(folder, force_refresh)["info_files"])
+
+
+def get_partials(folder:str, force_refresh=False) -> list:
+    """
+    return: list of unfinished download paths in a folder, with PARTIAL_EXT
+    """
+    return list(get_folder(folder, force_refresh)["partials"])
+
+
+def find_file(folders:list, filename:str) -> str | None:
+    """
+    Finds a model file by name in any of the given folders.
+    The index is refreshed once if the file is not found, in case
+    it was added since the last scan.
+
+    return: path:str or None
+    """
+    for force_refresh in (False, True):
+        for folder in folders:
+            if not (folder and os.path.isdir(folder)):
+                continue
+
+            for record in get_folder(folder, force_refresh)["models"].values():
+                if record["name"] == filename:
+                    return record["path"]
+
+    return None
+
+
+def get_info_ids(record:dict) -> tuple | None:
+    """
+    Reads the model id and version id of a model from its info file.
+
+    return: (model_id, version_id) or None
+    """
+    if not record["info"]:
+        return None
+
+    if record["info_ids"] is None:
+        record["info_ids"] = civitai.get_model_id_from_model_path(record["path"]) or False
+
+    return tuple(record["info_ids"]) if record["info_ids"] else None
+
+
+def update_model(model_path:str) -> None:
+    """
+    Updates the record of a single model after this extension has added,
+    moved or removed it or one of its sidecar files, without walking the
+    whole folder again.
+    """
+    model_path = os.path.normpath(model_path)
+    directory = os.path.dirname(model_path)
+    base, ext = os.path.splitext(os.path.basename(model_path))
+    info_file = os.path.join(directory, f"{base}{civitai.SUFFIX}{model.CIVITAI_EXT}")
+
+    try:
+        names = set(os.listdir(directory))
+        stat = os.stat(model_path)
+    except OSError:
+        names = set()
+        stat = None
+
+    with _lock:
+        for folder, folder_index in load_index().items():
+            dir_index = folder_index["dirs"].get(directory, None)
+            if dir_index is None:
+                continue
+
+            for view in (dir_index, _views.get(folder, None)):
+                if view is None:
+                    continue
+
+                models = view["models"]
+                info_files = view["info_files"]
+
+                if stat is None or ext not in model.EXTS:
+                    models.pop(model_path, None)
+                else:
+                    models[model_path] = make_record(model_path, base, stat, names)
+
+                if os.path.basename(info_file) in names:
+                    if info_file not in info_files:
+                        info_files.append(info_file)
+                elif info_file in info_files:
+                    info_files.remove(info_file)
+
+
+class DirectoryWatcher:
+    """
+    Tracks changed directories with inotify, so refreshing the index
+    does not need to check every directory.
+    """
+
+    def __init__(self):
+        self.inotify = INotify()
+        self.mask = (
+            inotify_flags.CREATE | inotify_flags.DELETE |
+            inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO |
+            inotify_flags.CLOSE_WRITE | inotify_flags.DELETE_SELF
+        )
+        self.lock = threading.Lock()
+
+        # {watch descriptor: directory}
+        self.watches = {}
+        # {folder: set(directory)}
+        self.watched = {}
+        # {folder: set(directory)}
+        self.changed = {}
+
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def watch(self, folder:str, directories) -> None:
+        """ Adds watches for every directory in a folder """
+        with self.lock:
+            watched = self.watched.setdefault(folder, set())
+            self.changed.setdefault(folder, set())
+
+            for directory in directories:
+                if directory in watched:
+                    continue
+
+                try:
+                    wd = self.inotify.add_watch(directory, self.mask)
+                except OSError as e:
+                    # usually fs.inotify.max_user_watches
+                    util.printD(f"Could not watch {directory}: {e}")
+                    continue
+
+                self.watches[wd] = directory
+                watched.add(directory)
+
+    def pop_changed(self, folder:str) -> set | None:
+        """
+        return: set of directories changed since the last call,
+        or None if the folder is not being watched.
+        """
+        with self.lock:
+            if folder not in self.watched:
+                return None
+
+            changed = self.changed[folder]
+            self.changed[folder] = set()
+            return changed
+
+    def run(self) -> None:
+        """ Marks directories as changed as inotify events arrive """
+        while True:
+            events = self.inotify.read()
+
+            with self.lock:
+                for event in events:
+                    directory = self.watches.get(event.wd, None)
+                    if directory is None:
+                        continue
+
+                    removed = event.mask & (inotify_flags.DELETE_SELF | inotify_flags.IGNORED)
+                    if removed:
+                        self.watches.pop(event.wd, None)
+
+                    for folder, watched in self.watched.items():
+                        if directory not in watched:
+                            continue
+
+                        self.changed[folder].add(directory)
+
+                        # a directory that was removed needs its parent rescanned
+                        if removed:
+                            watched.discard(directory)
+                            self.changed[folder].add(os.path.dirname(directory))
+
+
+def start_watcher() -> None:
+    """ Starts watching model folders with inotify, if enabled and available """
+    global _watcher
+
+    if _watcher or not util.get_opts("ch_inventory_inotify"):
+        return
+
+    if INotify is None:
+        util.printD("inotify_simple is not installed, model folders will not be watched.")
+        return
+
+    try:
+        _watcher = DirectoryWatcher()
+    except OSError as e:
+        util.printD(f"Could not start watching model folders: {e}")
@@ -9,6 +9,9 @@ from . import model
 from . import civitai
 from . import msg_handler
 from . import downloader
+from . import hash_cache
+from . import inventory
+from . import version_index
 
 
 def open_model_url(msg):
@@ -222,12 +225,7 @@ def dl_model_new_version(msg):
 
     success = False
     # download file + webui visible progress bar
-    headers = {
-        "content-type": "application/json"
-    }
-    api_key = util.get_opts("ch_civiai_api_key")
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
+    headers = civitai.get_download_headers()
     for result in downloader.dl_file(download_url, folder=model_folder, headers=headers):
         if not isinstance(result, str):
             success, output = result
@@ -338,6 +336,7 @@ def rename_model_by_path(msg):
     new_name = util.bash_filename(result["new_name"])
 
     renamed = []
+    new_model_path = None
     for candidate_file in model_files:
         new_path = make_new_filename(candidate_file, model_name, new_name)
         if new_path is None:
@@ -347,6 +346,16 @@ def rename_model_by_path(msg):
         util.printD(f"Renaming file {candidate_file} to {new_path}")
         os.rename(candidate_file, new_path)
 
+        if candidate_file == model_path:
+            hash_cache.move(candidate_file, new_path)
+            new_model_path = new_path
+
+    # update after every sidecar file has been renamed as well
+    inventory.update_model(model_path)
+    if new_model_path:
+        inventory.update_model(new_model_path)
+        version_index.move(model_path, new_model_path)
+
     renamed = "\n".join(renamed)
     status = f"The following files were renamed: \n{renamed}"
     util.info(status)
@@ -380,6 +389,11 @@ def remove_model_by_path(msg):
         removed.append(candidate_file)
         os.remove(candidate_file)
 
+        if candidate_file == model_path:
+            hash_cache.forget(candidate_file)
+
+    inventory.update_model(model_path)
+
     removed = "\n".join(removed)
     status = f"The following files were removed: \n{removed}"
     util.info(status)
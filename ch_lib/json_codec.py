@@ -0,0 +1,89 @@
+""" -*- coding: UTF-8 -*-
+JSON encoding and decoding.
+
+Uses orjson or msgspec when one of them is installed, as both parse and
+serialize several times faster than the standard library, and falls
+back to the json module otherwise. Decoding errors are always raised as
+ValueError, whichever backend is in use.
+
+Pretty output, used for the info files people read and edit, is always
+written by the json module with 4 space indents, so it looks the same
+whichever backend is installed.
+
+Files are read and written as UTF-8 bytes.
+"""
+from __future__ import annotations
+import json
+from . import util
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson:
+    BACKEND = "orjson"
+elif msgspec:
+    BACKEND = "msgspec"
+else:
+    BACKEND = "json"
+
+if msgspec:
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+
+
+def loads(data:bytes | str):
+    """ return: decoded JSON """
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+
+    if BACKEND == "msgspec":
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    return json.loads(data)
+
+
+def dumps(data, pretty=False) -> bytes:
+    """
+    pretty: indent the output for people to read
+    return: encoded JSON as UTF-8 bytes
+    """
+    if pretty:
+        return json.dumps(data, indent=4).encode("utf-8")
+
+    if BACKEND == "orjson":
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    if BACKEND == "msgspec":
+        return _msgspec_encoder.encode(data)
+
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def load_file(path:str):
+    """
+    Reads a JSON file.
+    return: decoded JSON
+    """
+    with open(path, "rb") as json_file:
+        return loads(json_file.read())
+
+
+def dump_file(path:str, data, pretty=False) -> None:
+    """ Writes data to a JSON file """
+    with open(path, "wb") as json_file:
+        json_file.write(dumps(data, pretty))
+
+
+def pretty_info_files() -> bool:
+    """ return: False if info files should be written in the compact format """
+    return not util.get_opts("ch_compact_json")
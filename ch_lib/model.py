@@ -1,10 +1,13 @@
 """ -*- coding: UTF-8 -*-
 Handle model operations
 """
+import copy
 import glob
 import os
-import json
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 import urllib.parse
 from PIL import Image
 import piexif
@@ -14,6 +17,9 @@ from modules import paths_internal
 from . import civitai
 from . import downloader
 from . import util
+from . import json_codec
+from . import inventory
+from . import version_index
 
 
 # this is the default root path
@@ -23,6 +29,20 @@ EXTS = (".bin", ".pt", ".safetensors", ".ckpt", ".gguf", ".zip")
 CIVITAI_EXT = ".info"
 SDWEBUI_EXT = ".json"
 
+# parsed info files, most recently used last
+INFO_CACHE_SIZE = 64
+_info_cache = OrderedDict()
+_info_cache_lock = threading.Lock()
+
+# example images are fetched in the background while scanning continues
+EXAMPLE_WORKERS = 4
+_example_executor = ThreadPoolExecutor(max_workers=EXAMPLE_WORKERS, thread_name_prefix="ch_examples")
+
+# info files are updated with fetched images one at a time
+_example_finalizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ch_examples_info")
+_example_pending = []
+_example_pending_lock = threading.Lock()
+
 """
 If command line arguement is used to change model folder,
 then model folder is in absolute path, not based on this root path anymore.
@@ -83,16 +103,117 @@ def local_image(model_info, img):
     return None
 
 
-def next_example_image_path(model_path):
+def next_example_image_paths(model_path, count):
     """
-    Find the next nonexistent path that can be used to store an example image.
-    return: path:str
+    Find the next `count` nonexistent paths that can be used to store
+    example images, listing the folder only once.
+    return: paths:list
     """
     base_path, _ = os.path.splitext(model_path)
+    prefix = f"{base_path}.example."
+
+    used = set()
+    for path in glob.glob(f"{glob.escape(prefix)}*.*"):
+        index = path[len(prefix):].split(".", 1)[0]
+        if index.isdigit():
+            used.add(int(index))
+
+    paths = []
     i = 0
-    while glob.glob(f"{base_path}.example.{i}.*"):
+    while len(paths) < count:
+        if i not in used:
+            paths.append(f"{prefix}{i}")
         i += 1
-    return f"{base_path}.example.{i}"
+
+    return paths
+
+
+def download_example_image(url, outpath):
+    """
+    Fetch one example image.
+    return: outpath:str, or None if the download failed
+    """
+    success = False
+    try:
+        for result in downloader.dl_file(
+                url,
+                folder=os.path.dirname(outpath),
+                filename=os.path.basename(outpath)):
+            if not isinstance(result, str):
+                success, _ = result
+                break
+
+    except Exception as e:
+        util.printD(f"An error has occurred while downloading an example image: {e}")
+
+    if not success:
+        downloader.error(url, "Failed to download model image.")
+        return None
+
+    return outpath
+
+
+def finish_example_images(model_path, info_file, downloads):
+    """
+    Wait for the example images of a model, then record the ones that
+    were fetched in its info file.
+    """
+    fetched = {}
+    for url, future in downloads:
+        outpath = future.result()
+        if outpath:
+            fetched[url] = outpath
+
+    if not (fetched and os.path.isfile(info_file)):
+        return
+
+    # the info file may have been rewritten while the images were downloading
+    model_info = copy.deepcopy(load_model_info(info_file))
+    if not model_info:
+        return
+
+    updated = False
+    for img in model_info.get("images", []):
+        outpath = fetched.get(img.get("url", None), None)
+        if outpath and img.get("local_file", None) != outpath:
+            img["local_file"] = outpath
+            updated = True
+
+    if updated:
+        write_info(model_info, info_file, "civitai")
+        inventory.update_model(model_path)
+
+
+def fetch_example_images(model_path, info_file, images):
+    """
+    Start downloading example images in the background. The info file is
+    updated with their local paths once all of them are done.
+    """
+    paths = next_example_image_paths(model_path, len(images))
+
+    downloads = []
+    for img, outpath in zip(images, paths):
+        url = img["url"]
+        _, ext = os.path.splitext(urllib.parse.urlparse(url).path)
+        future = _example_executor.submit(download_example_image, url, outpath + ext)
+        downloads.append((url, future))
+
+    finalizer = _example_finalizer.submit(finish_example_images, model_path, info_file, downloads)
+
+    with _example_pending_lock:
+        _example_pending[:] = [pending for pending in _example_pending if not pending.done()]
+        _example_pending.append(finalizer)
+
+
+def wait_for_example_images():
+    """ Block until every example image started so far is downloaded and recorded """
+    with _example_pending_lock:
+        pending = list(_example_pending)
+        _example_pending.clear()
+
+    for future in wait(pending).done:
+        if future.exception():
+            util.printD(f"Failed to record example images: {future.exception()}")
 
 
 # get custom model path
@@ -175,9 +296,7 @@ def metadata_needed_for_type(path, meta_type, refetch_old):
         return True
 
     if refetch_old:
-        metadata = None
-        with open(path) as file:
-            metadata = json.load(file)
+        metadata = json_codec.load_file(path)
 
         metadata_version = util.metadata_version(metadata)
 
@@ -203,8 +322,7 @@ def verify_overwrite_eligibility(path, new_data):
     if not os.path.isfile(path):
         return True
 
-    with open(path, "r") as file:
-        old_data = json.load(file)
+    old_data = json_codec.load_file(path)
 
     if "civitai" in path:
         new_id = new_data.get("id", "")
@@ -229,8 +347,12 @@ def verify_overwrite_eligibility(path, new_data):
 def write_info(data, path, info_type):
     """ Writes model info to a file """
     util.printD(f"Write model {info_type} info to file: {path}")
-    with open(os.path.realpath(path), 'w') as info_file:
-        info_file.write(json.dumps(data, indent=4))
+    path = os.path.realpath(path)
+    json_codec.dump_file(path, data, pretty=json_codec.pretty_info_files())
+
+    # a write within the mtime granularity could otherwise look unchanged
+    with _info_cache_lock:
+        _info_cache.pop(path, None)
 
 
 def process_model_info(model_path, model_info, model_type="ckp", refetch_old=False):
@@ -283,15 +405,14 @@ def process_model_info(model_path, model_info, model_type="ckp", refetch_old=Fal
 
     # Download preview images locally, for other extensions to display without
     # depending on civitai being up, or an internet connection at all.
-    updated = False
+    fetch_images = []
     if util.get_opts("ch_download_examples"):
         images = model_info.get("images", [])
+        nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
 
         for img in images:
             url = img.get("url", None)
 
-
-            nsfw_preview_threshold = util.get_opts("ch_nsfw_threshold")
             rating = img.get("nsfwLevel", 32)
             if rating > 1:
                 if civitai.NSFW_LEVELS[nsfw_preview_threshold] < rating:
@@ -304,28 +425,11 @@ def process_model_info(model_path, model_info, model_type="ckp", refetch_old=Fal
                     img["local_file"] = existing_dl
 
                 else:
-                    # Fetch it, save it, set it in the model info.
-                    path = urllib.parse.urlparse(url).path
-                    _, ext = os.path.splitext(path)
-                    outpath = next_example_image_path(model_path) + ext
-
-                    for result in downloader.dl_file(
-                            url,
-                            folder=os.path.dirname(outpath),
-                            filename=os.path.basename(outpath)):
-                        if not isinstance(result, str):
-                            success, output = result
-                            break
-
-                    if not success:
-                        downloader.error(url, "Failed to download model image.")
-                        continue
-
-                    img["local_file"] = outpath
-                    updated = True
+                    # Fetched in the background, which sets it in the info file.
+                    fetch_images.append(img)
 
     # civitai model info file
-    if metadata_needed_for_type(info_file, "civitai", refetch_old) or updated:
+    if metadata_needed_for_type(info_file, "civitai", refetch_old) or fetch_images:
         if refetch_old:
             try:
                 if verify_overwrite_eligibility(info_file, model_info):
@@ -338,6 +442,12 @@ def process_model_info(model_path, model_info, model_type="ckp", refetch_old=Fal
         else:
             write_info(model_info, info_file, "civitai")
 
+        inventory.update_model(model_path)
+        version_index.add(model_path, model_info)
+
+    if fetch_images:
+        fetch_example_images(model_path, info_file, fetch_images)
+
     if not util.get_opts("ch_dl_webui_metadata"):
         return
 
@@ -437,14 +547,33 @@ def process_sd15_info(sd15_file, model_info, parent, model_type, refetch_old):
 
 
 def load_model_info(path):
-    """ Opens a JSON file and loads its JSON """
-    model_info = None
-    with open(os.path.realpath(path), 'r') as json_file:
-        try:
-            model_info = json.load(json_file)
-        except ValueError:
-            util.printD(f"Selected file is not json: {path}")
-            return None
+    """
+    Opens a JSON file and loads its JSON
+
+    Parsed files are cached by path and revalidated by size and mtime,
+    so the returned data is shared and must be treated as read-only.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    identity = (stat.st_size, stat.st_mtime_ns)
+
+    with _info_cache_lock:
+        cached = _info_cache.get(path, None)
+        if cached and cached[0] == identity:
+            _info_cache.move_to_end(path)
+            return cached[1]
+
+    try:
+        model_info = json_codec.load_file(path)
+    except ValueError:
+        util.printD(f"Selected file is not json: {path}")
+        return None
+
+    with _info_cache_lock:
+        _info_cache[path] = (identity, model_info)
+        _info_cache.move_to_end(path)
+        while len(_info_cache) > INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
 
     return model_info
 
@@ -494,25 +623,9 @@ def get_model_names_by_type(model_type:str) -> list:
     return: model name list
     """
 
-    if model_type == "lora" and folders['lycoris']:
-        model_folders = [folders[model_type], folders['lycoris']]
-    else:
-        model_folders = [folders[model_type]]
-
-    # get information from filter
-    # only get those model names don't have a civitai model info file
-    model_names = []
-    for model_folder in model_folders:
-        for root, _, files in os.walk(model_folder, followlinks=True):
-            for filename in files:
-                item = os.path.join(root, filename)
-                # check extension
-                _, ext = os.path.splitext(item)
-                if ext in EXTS:
-                    # find a model
-                    model_names.append(filename)
-
-    return model_names
+    return [
+        record["name"] for record in inventory.get_models(model_type, with_lycoris=True)
+    ]
 
 
 # return 2 values: (model_root, model_path)
@@ -2,8 +2,8 @@
 handle msg between js and python side
 """
 import os
-import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import gradio as gr
 from modules import sd_models
 from . import util
@@ -11,6 +11,11 @@ from . import model
 from . import civitai
 from . import downloader
 from . import templates
+from . import hash_cache
+from . import inventory
+from . import version_index
+from . import response_cache
+from . import download_manager
 
 
 def get_metadata_skeleton():
@@ -49,10 +54,14 @@ def get_metadata_skeleton():
     return metadata
 
 
-def scan_single_model(filepath, model_type, refetch_old, organize_models, delay):
+def scan_single_model(filepath, model_type, refetch_old, organize_models, sha256_hash=None, model_info=None):
     """
     Gets model info for a model by feeding its sha256 hash into civitai's api
 
+    sha256_hash: hash computed ahead of time by `hash_models`, if any
+    model_info: model info looked up ahead of time by
+        `civitai.get_models_info_by_hashes`, if any
+
     return: success:bool
     """
 
@@ -72,12 +81,13 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
         yield output
 
         # get model's sha256
-        result = None
-        for result in util.gen_file_sha256(filepath, use_addnet_hash=use_auto_v3):
-            if isinstance(result, tuple):
-                yield result
+        if sha256_hash is None:
+            result = None
+            for result in util.gen_file_sha256(filepath, use_addnet_hash=use_auto_v3):
+                if isinstance(result, tuple):
+                    yield result
 
-        sha256_hash = result
+            sha256_hash = result
 
         util.printD(f"model action sha256: {sha256_hash}")
 
@@ -85,16 +95,16 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
             output = f"failed generating SHA256 for model: {filename}"
             util.printD(output)
             yield output
-            time.sleep(delay)
             yield False
 
         civitai_hash = sha256_hash
         if use_auto_v3:
             civitai_hash = sha256_hash[:12]
 
-        yield "Requesting model information from Civitai"
-        # use this sha256 to get model info from civitai
-        model_info = civitai.get_model_info_by_hash(civitai_hash)
+        if model_info is None:
+            yield "Requesting model information from Civitai"
+            # use this sha256 to get model info from civitai
+            model_info = civitai.get_model_info_by_hash(civitai_hash)
 
         if not model_info:
             model_info = dummy_model_info(filepath, civitai_hash, model_type)
@@ -107,21 +117,97 @@ def scan_single_model(filepath, model_type, refetch_old, organize_models, delay)
 
         model.process_model_info(filepath, model_info, model_type, refetch_old=refetch_old)
 
-        # delay before next request, to prevent being treated as a DDoS attack
-        time.sleep(delay)
-
     else:
         util.printD(f"Model metadata not needed for {filename}")
 
     yield True
 
 
-def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr.Progress()):
+def hash_models(filepaths, use_auto_v3, workers):
+    """
+    Hashes several model files at once using a bounded pool of worker threads.
+    hashlib releases the GIL while digesting large blocks, so this scales
+    with the number of workers until the disk becomes the bottleneck.
+
+    yields: (filepath, sha256_hash) as each file finishes
+    """
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                util.get_file_sha256, filepath, use_addnet_hash=use_auto_v3
+            ): filepath for filepath in filepaths
+        }
+
+        for future in as_completed(futures):
+            filepath = futures[future]
+            try:
+                sha256_hash = future.result()
+            except OSError as e:
+                util.printD(f"Failed to hash {filepath}: {e}")
+                sha256_hash = None
+
+            yield (filepath, sha256_hash)
+
+
+def resolve_models(models, refetch_old, use_auto_v3, workers, progress):
+    """
+    Hashes models that need metadata in groups of `civitai.HASH_BATCH_SIZE`,
+    then looks up each group's hashes on Civitai with a single request.
+
+    yields: (filepath, model_type, sha256_hash, model_info) for every model,
+        with None for anything that was not resolved ahead of time.
+    """
+    for start in range(0, len(models), civitai.HASH_BATCH_SIZE):
+        group = models[start:start + civitai.HASH_BATCH_SIZE]
+
+        needs_hash = [
+            filepath for filepath, _ in group
+            if model.metadata_needed(*model.get_model_info_paths(filepath), refetch_old)
+        ]
+
+        hashes = {}
+        for filepath, sha256_hash in hash_models(needs_hash, use_auto_v3, workers):
+            hashes[filepath] = sha256_hash
+            progress(
+                (start + len(hashes), len(models)),
+                desc=f"Hashed {os.path.basename(filepath)}",
+                unit="models"
+            )
+
+        civitai_hashes = {
+            filepath: sha256_hash[:12] if use_auto_v3 else sha256_hash
+            for filepath, sha256_hash in hashes.items() if sha256_hash
+        }
+
+        models_info = {}
+        if civitai_hashes:
+            progress(
+                (start, len(models)),
+                desc="Requesting model information from Civitai",
+                unit="models"
+            )
+            models_info = civitai.get_models_info_by_hashes(
+                list(civitai_hashes.values())
+            )
+
+        for filepath, model_type in group:
+            civitai_hash = civitai_hashes.get(filepath, None)
+            model_info = None
+            if civitai_hash:
+                model_info = models_info.get(civitai_hash.upper(), None)
+
+            yield (filepath, model_type, hashes.get(filepath, None), model_info)
+
+
+def scan_model(scan_model_types, refetch_old, organize_models=False, refresh_cache=False, progress=gr.Progress()):
     """ Scan model to generate SHA256, then use this SHA256 to get model info from civitai
+        refresh_cache: revalidate cached Civitai responses
         return output msg
     """
 
-    delay = 0.2
+    if refresh_cache:
+        response_cache.force_refresh()
 
     util.printD("Start scan_model")
     output = ""
@@ -142,64 +228,81 @@ def scan_model(scan_model_types, refetch_old, organize_models=False, progress=gr
         # check if type is a string
         model_types = [scan_model_types]
 
+    # rebuild the inventory once, even when model types share a folder
+    inventory.refresh(list({
+        model_folder for model_type, model_folder in model.folders.items()
+        if model_type in model_types
+    }))
+
     models = []
     for model_type, model_folder in model.folders.items():
         if model_type not in model_types:
             continue
 
         util.printD(f"Scanning path: {model_folder}")
-        for root, _, files in os.walk(model_folder, followlinks=True):
-            for filename in files:
-
-                # check ext
-                filepath = os.path.join(root, filename)
-                _, ext = os.path.splitext(filepath)
-                if ext not in model.EXTS:
-                    continue
+        for record in inventory.get_folder(model_folder)["models"].values():
+            models.append((record["path"], model_type))
 
-                models.append((filepath, model_type))
+    hash_workers = int(util.get_opts("ch_hash_workers") or 1)
+    use_auto_v3 = util.get_opts("ch_autov3")
 
     count = [0, 0]
     total = len(models)
-    for filepath, model_type in models:
-        success = None
 
-        tracker = (count[0], total)
+    # versions of the same model share their parent model's metadata
+    with civitai.memoize_parent_models():
+        for filepath, model_type, sha256_hash, model_info in resolve_models(
+            models, refetch_old, use_auto_v3, hash_workers, progress
+        ):
+            success = None
+
+            tracker = (count[0], total)
 
-        progress(
-            tracker,
-            desc="Scanning...",
-            unit="models"
-        )
+            progress(
+                tracker,
+                desc="Scanning...",
+                unit="models"
+            )
 
-        count[0] = count[0] + 1
+            count[0] = count[0] + 1
 
-        for result in scan_single_model(filepath, model_type, refetch_old, organize_models, delay):
-            if isinstance(result, str):
-                progress(tracker, desc=result, unit="models")
-                continue
+            for result in scan_single_model(
+                filepath, model_type, refetch_old, organize_models,
+                sha256_hash=sha256_hash, model_info=model_info
+            ):
+                if isinstance(result, str):
+                    progress(tracker, desc=result, unit="models")
+                    continue
+
+                if isinstance(result, tuple):
+                    percent, status = result
+                    progress(percent, desc=status)
+                    continue
+
+                success = result
+                break
 
-            if isinstance(result, tuple):
-                percent, status = result
-                progress(percent, desc=status)
+            if not success:
                 continue
 
-            success = result
-            break
+            # set model_count
+            count[1] = count[1] + 1
 
-        if not success:
-            continue
+            # check preview image
+            for _ in civitai.get_preview_image_by_model_path(
+                filepath,
+                max_size_preview,
+                nsfw_preview_threshold
+            ):
+                pass
 
-        # set model_count
-        count[1] = count[1] + 1
+    # example images were fetched in the background while scanning
+    progress(1, desc="Waiting for example images...")
+    model.wait_for_example_images()
 
-        # check preview image
-        for _ in civitai.get_preview_image_by_model_path(
-            filepath,
-            max_size_preview,
-            nsfw_preview_threshold
-        ):
-            pass
+    hash_cache.flush()
+    version_index.flush()
+    response_cache.flush()
 
     # this previously had an image count, but it always matched the model count.
     output = f"Done. Successfully scanned {count[1]} of {len(models)} models."
@@ -372,12 +475,16 @@ def build_article_from_version(version):
     return article
 
 
-def check_models_new_version_to_md(model_types:list) -> str:
+def check_models_new_version_to_md(model_types:list, refresh_cache=False) -> str:
     """
     check models' new version and output to UI as html doc
+    refresh_cache: revalidate cached Civitai responses
     return: html:str
     """
-    new_versions = civitai.check_models_new_version_by_model_types(model_types, 0.2)
+    if refresh_cache:
+        response_cache.force_refresh()
+
+    new_versions = civitai.check_models_new_version_by_model_types(model_types)
 
     if not new_versions:
         util.printD("Done: no new versions found.")
@@ -603,7 +710,8 @@ def parse_file_info(file_info, basename):
     return {
         "url": download_url,
         "filename": filename,
-        "type": filetype
+        "type": filetype,
+        "sha256": file_info.get("hashes", {}).get("SHA256", None)
     }
 
 
@@ -667,7 +775,7 @@ def download_files(filename, model_folder, ver_info, headers, filetypes, dl_all,
         # webui visible progress bar
         for result in downloader.dl_file(
             url, filename=dl_info["filename"], folder=dl_folder, duplicate=duplicate,
-            headers=headers
+            headers=headers, sha256=dl_info["sha256"]
         ):
             if not isinstance(result, str):
                 success, output = result
@@ -836,12 +944,7 @@ def dl_model_by_input(
         yield output
         return
 
-    headers = {
-        "content-type": "application/json"
-    }
-    api_key = util.get_opts("ch_civiai_api_key")
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
+    headers = civitai.get_download_headers()
 
     additional = None
     for result in download_files(filename, folder, ver_info, headers, filetypes, dl_all, duplicate):
@@ -860,7 +963,7 @@ def dl_model_by_input(
         return
 
     # get version info
-    version_info = civitai.get_version_info_by_version_id(ver_info["id"])
+    version_info = civitai.get_version_info_by_version_id(ver_info["id"], model_info)
     model.process_model_info(output, version_info, model_type)
 
     # then, get preview image + webui-visible progress
@@ -877,3 +980,42 @@ def dl_model_by_input(
         output = f"{output}. Additionally, the following failures occurred: \n{additional}"
     util.printD(output)
     yield output
+
+
+def queue_model_download(
+    ch_state:dict,
+    model_type:str,
+    subfolder_str:str,
+    version_str:str,
+    filename:str,
+    file_ext:str,
+    dl_all:bool,
+    duplicate:str,
+    preview:str,
+    *args
+) -> str:
+    """ queue a download of the model chosen in the download section
+        output its status to markdown log until it is done
+    """
+
+    model_info = ch_state["model_info"]
+    if not model_info:
+        output = "No model selected. Get the model info first."
+        util.printD(output)
+        yield output
+        return
+
+    job_id = download_manager.submit(
+        model_info,
+        model_type,
+        subfolder_str,
+        version_str,
+        filename,
+        file_ext,
+        dl_all,
+        duplicate,
+        preview,
+        args
+    )
+
+    yield from download_manager.follow([job_id])
@@ -0,0 +1,113 @@
+""" -*- coding: UTF-8 -*-
+Rate limiting for requests to the Civitai API.
+
+Every API request takes a token from a shared token bucket before it is
+sent. Tokens are refilled at `ch_api_rate` per second, up to `ch_api_burst`
+saved tokens, so short bursts go out immediately while the long term rate
+stays within the limit no matter how many threads are making requests.
+"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from . import util
+
+DEFAULT_RATE = 4
+DEFAULT_BURST = 8
+DEFAULT_WORKERS = 4
+
+
+class TokenBucket:
+    """ Thread-safe token bucket """
+
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def configure(self, rate:float, burst:int) -> None:
+        """ Changes the rate and burst size, keeping saved tokens """
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def acquire(self) -> None:
+        """ Waits until a token is available and takes it """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def consume(self, count:float) -> None:
+        """
+        Takes `count` tokens, which may be more than the burst size.
+        The bucket goes into debt and the caller waits until it is paid
+        off, so callers sharing the bucket queue up in turn.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens = self.tokens - count
+
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+_bucket = TokenBucket(DEFAULT_RATE, DEFAULT_BURST)
+
+
+def get_settings() -> tuple[float, int]:
+    """ return: (requests per second, burst) from settings """
+    rate = float(util.get_opts("ch_api_rate") or DEFAULT_RATE)
+    burst = int(util.get_opts("ch_api_burst") or DEFAULT_BURST)
+
+    return (max(rate, 0.1), max(burst, 1))
+
+
+def acquire() -> None:
+    """ Waits until another Civitai API request is allowed """
+    rate, burst = get_settings()
+    if (rate, burst) != (_bucket.rate, _bucket.burst):
+        _bucket.configure(rate, burst)
+
+    _bucket.acquire()
+
+
+def get_workers() -> int:
+    """ return: number of Civitai API requests to run at the same time """
+    return max(int(util.get_opts("ch_api_workers") or DEFAULT_WORKERS), 1)
+
+
+def map_requests(func, items:list) -> list:
+    """
+    Calls func for every item using a pool of API workers.
+    Requests made by func are still rate limited.
+
+    return: list of results, in the order of items
+    """
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(get_workers(), len(items))) as executor:
+        return list(executor.map(func, items))
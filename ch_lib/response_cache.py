@@ -0,0 +1,266 @@
+""" -*- coding: UTF-8 -*-
+Persistent cache of Civitai API responses.
+
+Responses are stored per URL along with their ETag and Last-Modified
+headers. A cached response is reused until it is older than the time to
+live of its endpoint. After that it is revalidated with a conditional
+request, which costs a round trip but not the response body when the
+data has not changed.
+
+The cache is bounded in size. The least recently used responses are
+evicted first.
+"""
+from __future__ import annotations
+import atexit
+import hashlib
+import os
+import threading
+import time
+from . import util
+from . import json_codec
+
+CACHE_DIR = "responses"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+
+FLUSH_SECONDS = 5
+
+_lock = threading.Lock()
+
+# {url: {"file": str, "size": int, "fetched": float, "used": float,
+#        "etag": str, "last_modified": str}}
+_index = None
+
+_flush_timer = None
+
+# responses fetched before this time are treated as stale
+_refresh_after = 0
+
+
+def get_max_size() -> int:
+    """ return: maximum cache size in bytes, 0 if the cache is disabled """
+    size_mb = util.get_opts("ch_api_cache_size")
+    if size_mb is None:
+        size_mb = 64
+
+    return int(size_mb) * 1024 * 1024
+
+
+def get_response_dir() -> str:
+    """ return: directory cached responses are stored in """
+    path = os.path.join(util.get_cache_dir(), CACHE_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_index() -> dict:
+    """ Loads the cache index on first use """
+    global _index
+
+    if _index is not None:
+        return _index
+
+    _index = {}
+
+    path = os.path.join(get_response_dir(), INDEX_FILE)
+    if not os.path.isfile(path):
+        return _index
+
+    try:
+        data = json_codec.load_file(path)
+
+        if data.get("version", None) == INDEX_VERSION:
+            _index = data.get("responses", {})
+
+    except (OSError, ValueError) as e:
+        util.printD(f"Could not load API response cache index: {e}")
+
+    return _index
+
+
+def save_index() -> None:
+    """ Writes the cache index to disk """
+    global _flush_timer
+
+    with _lock:
+        if _flush_timer:
+            _flush_timer.cancel()
+            _flush_timer = None
+
+        if _index is None:
+            return
+
+        data = {
+            "version": INDEX_VERSION,
+            "responses": _index,
+        }
+
+        try:
+            util.write_json_atomic(os.path.join(get_response_dir(), INDEX_FILE), data, durable=False)
+        except OSError as e:
+            util.printD(f"Could not save API response cache index: {e}")
+
+
+def mark_dirty() -> None:
+    """ Schedules a write of the index, batching changes made close together """
+    global _flush_timer
+
+    with _lock:
+        if _flush_timer:
+            return
+
+        _flush_timer = threading.Timer(FLUSH_SECONDS, save_index)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def flush() -> None:
+    """ Writes the index now if it has pending changes """
+    if _flush_timer:
+        save_index()
+
+
+atexit.register(flush)
+
+
+def force_refresh() -> None:
+    """
+    Makes every response cached before now stale, so the next request for
+    it is revalidated with Civitai. Responses fetched after this call are
+    cached as usual.
+    """
+    global _refresh_after
+    _refresh_after = time.time()
+
+
+def get(url:str) -> dict | None:
+    """
+    Finds the cache entry for a URL.
+
+    return: entry:dict or None
+    """
+    if not get_max_size():
+        return None
+
+    with _lock:
+        entry = load_index().get(url, None)
+        return dict(entry) if entry else None
+
+
+def is_fresh(entry:dict, ttl:int) -> bool:
+    """ return: True if the entry can be used without asking Civitai """
+    if entry["fetched"] < _refresh_after:
+        return False
+
+    return not util.is_stale(entry["fetched"], ttl)
+
+
+def get_conditional_headers(entry:dict | None) -> dict:
+    """ return: headers used to revalidate an entry """
+    headers = {}
+    if not entry:
+        return headers
+
+    if entry.get("etag", None):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified", None):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    return headers
+
+
+def load_content(entry:dict):
+    """
+    Reads a cached response. Each call returns a new object,
+    so callers are free to modify it.
+
+    return: content or None if the response is no longer on disk
+    """
+    path = os.path.join(get_response_dir(), entry["file"])
+
+    try:
+        content = json_codec.load_file(path)
+
+    except (OSError, ValueError):
+        return None
+
+    now = time.time()
+    with _lock:
+        stored = load_index().get(entry["url"], None)
+        if stored:
+            stored["used"] = now
+
+    mark_dirty()
+
+    return content
+
+
+def revalidated(entry:dict) -> None:
+    """ Records that Civitai confirmed an entry is unchanged """
+    now = time.time()
+    with _lock:
+        stored = load_index().get(entry["url"], None)
+        if stored:
+            stored["fetched"] = now
+            stored["used"] = now
+
+    mark_dirty()
+
+
+def store(url:str, content, headers) -> None:
+    """ Adds a response to the cache, evicting old responses if needed """
+    max_size = get_max_size()
+    if not max_size:
+        return
+
+    filename = f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+    data = json_codec.dumps(content)
+    if len(data) > max_size:
+        return
+
+    path = os.path.join(get_response_dir(), filename)
+    try:
+        util.write_bytes_atomic(path, data, durable=False)
+    except OSError as e:
+        util.printD(f"Could not cache API response: {e}")
+        return
+
+    now = time.time()
+    with _lock:
+        load_index()[url] = {
+            "url": url,
+            "file": filename,
+            "size": len(data),
+            "fetched": now,
+            "used": now,
+            "etag": headers.get("ETag", None),
+            "last_modified": headers.get("Last-Modified", None),
+        }
+
+    evict(max_size)
+    mark_dirty()
+
+
+def evict(max_size:int) -> None:
+    """ Removes the least recently used responses until the cache fits max_size """
+    with _lock:
+        index = load_index()
+        total = sum(entry["size"] for entry in index.values())
+        if total <= max_size:
+            return
+
+        removed = []
+        for entry in sorted(index.values(), key=lambda entry: entry["used"]):
+            if total <= max_size:
+                break
+
+            total = total - entry["size"]
+            removed.append(entry)
+            del index[entry["url"]]
+
+    for entry in removed:
+        try:
+            os.remove(os.path.join(get_response_dir(), entry["file"]))
+        except OSError:
+            pass
+
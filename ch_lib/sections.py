@@ -8,6 +8,7 @@ from . import js_action_civitai
 from . import model_action_civitai
 from . import civitai
 from . import duplicate_check
+from . import download_manager
 from . import util
 
 model_types = list(model.folders.keys())
@@ -35,6 +36,11 @@ def scan_models_section():
                 value=False,
                 elem_id="ch_refetch_old_ckb"
             )
+            scan_refresh_cache_ckb = gr.Checkbox(
+                label="Refresh cached Civitai data",
+                value=False,
+                elem_id="ch_scan_refresh_cache_ckb"
+            )
             gr.HTML("""
                 * [<a href=https://github.com/zixaphir/Stable-Diffusion-Webui-Civitai-Helper/wiki/Metadata-Format-Changes>wiki</a>] Do not use this option if you have made changes with the metadata editor without backing up your data!!<br><br>
                 """)
@@ -64,7 +70,8 @@ def scan_models_section():
         inputs=[
             scan_model_types_drop,
             refetch_old_ckb,
-            organize_models
+            organize_models,
+            scan_refresh_cache_ckb
         ],
         outputs=scan_model_log_md
     )
@@ -627,7 +634,7 @@ def download_section():
         ] + ch_dl_model_types
 
     dl_civitai_model_by_id_btn.click(
-        model_action_civitai.dl_model_by_input,
+        model_action_civitai.queue_model_download,
         inputs=dl_inputs,
         outputs=dl_log_md
     )
@@ -870,44 +877,23 @@ def download_multiple_section():
 
             dls.append(dl)
 
-        i = 0
-        count = len(dls)
-        download_results = []
+        job_ids = []
         for dl in dls:
-            i = i + 1
-            progress = None
-            try:
-                dl_status = "\n".join(download_results)
-                status_msg = f"```\nCompleted:\n{dl_status}\n```"
-                for progress in model_action_civitai.dl_model_by_input(
-                    {"model_info": dl["model_info"]},
-                    dl["model_type"],
-                    dl["subfolder"],
-                    dl["version_str"],
-                    dl["filename"],
-                    dl["file_ext"],
-                    dl["dl_all"],
-                    dl["duplicate"],
-                    dl["preview"],
-                    *dl["filetypes"]
-                ):
-                    yield f"{dl['model_name']} {i}/{count} {progress} \n {status_msg}"
-
-                download_results.append(f"{dl['model_name']}: {progress}")
-            except Exception as e:
-                msg = None
-                if hasattr(e, 'message'):
-                    msg = e.message
-                else:
-                    msg = e
-
-                output = f"An error has occurred while downloading: {msg}\n{e.args}"
-                util.printD(output)
-                download_results.append(f" * {dl['model_name']}: {output}")
-
-        download_results = "\n".join(download_results)
-        yield f"```\nCompleted:\n{download_results}\n```"
-        return
+            job_ids.append(download_manager.submit(
+                dl["model_info"],
+                dl["model_type"],
+                dl["subfolder"],
+                dl["version_str"],
+                dl["filename"],
+                dl["file_ext"],
+                dl["dl_all"],
+                dl["duplicate"],
+                dl["preview"],
+                dl["filetypes"],
+                priority=download_manager.PRIORITY_BATCH
+            ))
+
+        yield from download_manager.follow(job_ids)
 
     with gr.Row():
         gr.Markdown("""
@@ -964,6 +950,7 @@ def download_multiple_section():
 
     with gr.Row():
         submit_btn = gr.Button(value="Download Models", variant="primary")
+        queue_btn = gr.Button(value="Show Download Queue")
 
     with gr.Row():
         dl_all_log_md = gr.Markdown(
@@ -992,6 +979,12 @@ def download_multiple_section():
         outputs=dl_all_log_md
     )
 
+    queue_btn.click(
+        lambda: download_manager.format_status(download_manager.get_jobs()),
+        inputs=None,
+        outputs=dl_all_log_md
+    )
+
 
 def scan_for_duplicates_section():
     """ Scan Duplicate Models Section """
@@ -1054,6 +1047,11 @@ def check_new_versions_section(js_msg_txtbox):
                     value="Check New Version from Civitai",
                     variant="primary"
                 )
+            with gr.Column(scale=1):
+                new_version_refresh_cache_ckb = gr.Checkbox(
+                    label="Refresh cached Civitai data",
+                    value=False
+                )
 
         with gr.Row():
             with gr.Column():
@@ -1065,7 +1063,7 @@ def check_new_versions_section(js_msg_txtbox):
     # ====events====
     check_models_new_version_btn.click(
         model_action_civitai.check_models_new_version_to_md,
-        inputs=model_types_ckbg,
+        inputs=[model_types_ckbg, new_version_refresh_cache_ckb],
         outputs=check_models_new_version_log_md
     )
 
@@ -5,15 +5,24 @@ from __future__ import annotations
 import os
 import io
 import re
+import tempfile
 import hashlib
 import textwrap
+import threading
 import time
+import zlib
 import gradio as gr
 from modules import shared
 from modules.shared import opts
 from modules import hashes
 from packaging.version import parse as parse_version
 
+try:
+    from blake3 import blake3
+except ImportError:
+    # optional, only used when extra hashes are enabled
+    blake3 = None
+
 try:
     # Automatic1111 SD WebUI
     import modules.cache as sha256_cache
@@ -21,6 +30,10 @@ except ModuleNotFoundError:
     # Vladmandic "SD.Next"
     import modules.hashes as sha256_cache
 
+from . import hash_cache
+from . import json_codec
+from . import inventory
+
 # used to append extension information to JSON/INFO files
 SHORT_NAME = "sd_civitai_helper"
 
@@ -45,6 +58,10 @@ PROXIES = {
     "https": None,
 }
 
+# bounds for adaptive block sizes used when hashing files
+HASH_BLOCK_MIN = 1 << 20  # 1 MiB
+HASH_BLOCK_MAX = 1 << 24  # 16 MiB
+
 REQUEST_TIMEOUT = 300  # 5 minutes
 REQUEST_RETRIES = 5
 
@@ -54,6 +71,9 @@ _DAY = _HOUR * 24
 
 GRADIO_FALLBACK = False
 
+# guards webui's hash cache when files are hashed from several threads
+_hash_cache_lock = threading.Lock()
+
 script_dir = None
 
 # print for debugging
@@ -106,12 +126,12 @@ def delay(seconds:float) -> None:
     time.sleep(seconds)
 
 
-def is_stale(timestamp:float) -> bool:
-    """ Returns if a timestamp was more than a day ago. """
+def is_stale(timestamp:float, max_age:float=_DAY) -> bool:
+    """ Returns if a timestamp was more than max_age seconds (default a day) ago. """
     cur_time = ch_time()
     elapsed = cur_time - timestamp
 
-    if elapsed > _DAY:
+    if elapsed > max_age:
         return True
 
     return False
@@ -154,21 +174,90 @@ def get_opts(key):
     return opts.data.get(key, None)
 
 
+def get_cache_dir() -> str:
+    """ return: directory for caches owned by this extension """
+    base_dir = script_dir or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cache_dir = os.path.join(base_dir, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+class FileDigests:
+    """
+    Computes every hash Civitai can identify a file by in a single pass:
+    the full-file SHA256, the AutoV3 SHA256 of the safetensors body
+    after its header, and optionally CRC32 and BLAKE3.
+
+    Data must be fed in file order with `update`. The safetensors header
+    length is read from the first 8 bytes of the stream.
+    """
+
+    def __init__(self, autov3=False, extra=False):
+        self.pos = 0
+        self.header = bytearray()
+        self.offset = None
+
+        self.sha256 = hashlib.sha256()
+        self.autov3 = hashlib.sha256() if autov3 else None
+        self.crc32 = 0 if extra else None
+        self.blake3 = blake3(max_threads=blake3.AUTO) if (extra and blake3) else None
+
+    def update(self, data) -> None:
+        """ Feed the next block of the file to every digest """
+        start = self.pos
+        self.pos += len(data)
+
+        self.sha256.update(data)
+
+        if self.crc32 is not None:
+            self.crc32 = zlib.crc32(data, self.crc32)
+
+        if self.blake3 is not None:
+            self.blake3.update(data)
+
+        if self.autov3 is None:
+            return
+
+        if self.offset is None:
+            self.header += data[:8 - len(self.header)]
+            if len(self.header) < 8:
+                return
+            self.offset = int.from_bytes(self.header, "little") + 8
+
+        if self.pos > self.offset:
+            self.autov3.update(data[max(self.offset - start, 0):])
+
+    def hexdigests(self) -> dict:
+        """ return: dict of hash name to hex digest """
+        digests = {"sha256": self.sha256.hexdigest()}
+
+        if self.autov3 is not None:
+            digests["autov3"] = self.autov3.hexdigest()
+
+        if self.crc32 is not None:
+            digests["crc32"] = f"{self.crc32:08x}"
+
+        if self.blake3 is not None:
+            digests["blake3"] = self.blake3.hexdigest()
+
+        return digests
+
+
 def gen_file_sha256(filename:str, model_type="lora", use_addnet_hash=False) -> str:
     """ return a sha256 hash for a file """
 
-    cache = sha256_cache.cache
-    dump_cache = sha256_cache.dump_cache
     model_name = get_name(filename, model_type)
+    hash_name = "autov3" if use_addnet_hash else "sha256"
 
-    sha256_hashes = None
-    if use_addnet_hash:
-        sha256_hashes = cache("hashes-addnet")
-    else:
-        sha256_hashes = cache("hashes")
+    # survives renames and moves
+    cached = hash_cache.lookup(filename)
+    if cached and hash_name in cached:
+        yield cached[hash_name]
+        return
 
     sha256_value = hashes.sha256_from_cache(filename, model_name, use_addnet_hash)
     if sha256_value is not None:
+        hash_cache.store(filename, {hash_name: sha256_value})
         yield sha256_value
         return
 
@@ -178,50 +267,154 @@ def gen_file_sha256(filename:str, model_type="lora", use_addnet_hash=False) -> s
         yield None
         return
 
-    with open(filename, "rb") as model_file:
-        result = None
-        for result in calculate_sha256(model_file, use_addnet_hash):
+    result = None
+    for result in gen_file_hashes(filename, use_addnet_hash):
+        if isinstance(result, tuple):
             yield result
-        sha256_value = result
 
-    printD(f"sha256: {sha256_value}")
+    digests = result
 
-    sha256_hashes[model_name] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
+    cache_file_hashes(filename, digests, model_type)
+
+    sha256_value = digests[hash_name]
 
-    dump_cache()
+    printD(f"sha256: {sha256_value}")
 
     yield sha256_value
 
+
+def gen_file_hashes(filename:str, autov3=False) -> dict:
+    """
+    Reads a file once and computes all of its hashes.
+    The AutoV3 hash is always computed for safetensors files.
+
+    yields: progress tuples, then dict:digests
+    """
+
+    autov3 = autov3 or filename.endswith(".safetensors")
+    digests = FileDigests(autov3=autov3, extra=get_opts("ch_extra_hashes"))
+
+    # unbuffered: reads go straight into calculate_hashes' buffer
+    with open(filename, "rb", buffering=0) as model_file:
+        yield from calculate_hashes(model_file, digests)
+
+    yield digests.hexdigests()
+
+
+def cache_file_hashes(filename:str, digests:dict, model_type="lora") -> None:
+    """
+    Stores every computed hash for a file together in the extension's
+    hash cache and webui's hash cache. The AutoV3 hash is also stored
+    where webui looks up addnet hashes.
+    """
+
+    cache = sha256_cache.cache
+    model_name = get_name(filename, model_type)
+    mtime = os.path.getmtime(filename)
+
+    with _hash_cache_lock:
+        cache("hashes")[model_name] = {
+            "mtime": mtime,
+            **digests
+        }
+
+        if "autov3" in digests:
+            cache("hashes-addnet")[model_name] = {
+                "mtime": mtime,
+                "sha256": digests["autov3"],
+            }
+
+    # writing webui's cache.json is deferred to hash_cache.flush
+    hash_cache.store(filename, digests, webui=True)
+
+
+def dump_webui_hash_cache() -> None:
+    """ Writes webui's hash cache to disk """
+    with _hash_cache_lock:
+        sha256_cache.dump_cache()
+
+
+def write_json_atomic(path:str, data, durable=True) -> None:
+    """ Writes JSON to `path` with write_bytes_atomic """
+    write_bytes_atomic(path, json_codec.dumps(data), durable)
+
+
+def write_bytes_atomic(path:str, data:bytes, durable=True) -> None:
+    """
+    Writes to a temporary file next to `path`, then replaces `path`
+    with it, so a crash never leaves a truncated file behind.
+
+    durable: flush the file to disk before replacing `path`. Not needed
+    for caches, which can be rebuilt if a crash loses the last write.
+    """
+    folder, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".tmp", dir=folder)
+
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            if durable:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_file_sha256(filename:str, model_type="lora", use_addnet_hash=False) -> str:
+    """
+    Non-generator wrapper for gen_file_sha256, for use in worker threads.
+
+    return: sha256:str or None
+    """
+    result = None
+    for result in gen_file_sha256(filename, model_type, use_addnet_hash):
+        pass
+
+    return result
+
+
 def calculate_sha256(model_file, use_addnet_hash=False):
     """ calculate the sha256 hash for a model file """
 
-    blocksize= 1 << 20
-    sha256_hash = hashlib.sha256()
+    digests = FileDigests(autov3=use_addnet_hash)
 
-    size = os.fstat(model_file.fileno()).st_size
+    result = None
+    for result in calculate_hashes(model_file, digests):
+        if isinstance(result, tuple):
+            yield result
 
-    offset = 0
     if use_addnet_hash:
-        model_file.seek(0)
-        header= model_file.read(8)
-        offset = int.from_bytes(header, "little") + 8
-        model_file.seek(offset)
+        yield digests.autov3.hexdigest()
+        return
+
+    yield digests.sha256.hexdigest()
 
-    pos = 0
-    for block in read_chunks(model_file, size=blocksize):
-        pos += len(block)
 
-        percent = (pos - offset) / (size - offset)
+def calculate_hashes(model_file, digests:FileDigests):
+    """
+    Feeds a whole model file into `digests`.
+
+    yields: progress tuples
+    """
 
-        yield (percent, f"hashing model {model_file.name}")
+    size = max(os.fstat(model_file.fileno()).st_size, 1)
+    buffer = bytearray(HASH_BLOCK_MAX)
 
-        sha256_hash.update(block)
+    model_file.seek(0)
 
-    hash_value =  sha256_hash.hexdigest()
-    yield hash_value
+    last_tick = 0
+    for block in read_into_chunks(model_file, buffer):
+        digests.update(block)
+
+        # Gradio progress updates are slow. Don't send one per block.
+        timer = time.time()
+        if timer - last_tick > 0.2:
+            last_tick = timer
+            yield (digests.pos / size, f"hashing model {model_file.name}")
 
 
 def read_chunks(file, size=io.DEFAULT_BUFFER_SIZE) -> bytes:
@@ -233,6 +426,36 @@ def read_chunks(file, size=io.DEFAULT_BUFFER_SIZE) -> bytes:
         yield chunk
 
 
+def read_into_chunks(file, buffer:bytearray) -> memoryview:
+    """
+    Yield pieces of data from a file-like object until EOF, reusing
+    `buffer` for every read instead of allocating a new bytes object.
+
+    The block size starts at HASH_BLOCK_MIN and adapts to the measured
+    read time, growing while reads are quick and shrinking when they
+    stall, up to the size of `buffer`.
+
+    Each yielded memoryview is only valid until the next iteration.
+    """
+    view = memoryview(buffer)
+    blocksize = min(HASH_BLOCK_MIN, len(buffer))
+
+    while True:
+        start = time.perf_counter()
+        read = file.readinto(view[:blocksize])
+        elapsed = time.perf_counter() - start
+
+        if not read:
+            break
+
+        yield view[:read]
+
+        if elapsed < 0.02 and blocksize < len(buffer):
+            blocksize = blocksize << 1
+        elif elapsed > 0.25 and blocksize > HASH_BLOCK_MIN:
+            blocksize = blocksize >> 1
+
+
 def get_subfolders(folder:str) -> list[str]:
     """ return: list of subfolders """
     printD(f"Get subfolder for: {folder}")
@@ -281,13 +504,7 @@ def find_file_in_folders(folders:list, filename:str) -> str:
 
     return: filename:str or None
     """
-    for folder in folders:
-        for root, _, files in os.walk(folder, followlinks=True):
-            if filename in files:
-                # found file
-                return os.path.join(root, filename)
-
-    return None
+    return inventory.find_file(folders, filename)
 
 
 # get relative path
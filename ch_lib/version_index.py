@@ -0,0 +1,266 @@
+""" -*- coding: UTF-8 -*-
+Persistent index of local models by Civitai model id and version id.
+
+Used to check whether a model version has already been downloaded without
+parsing every civitai info file in a folder. The index is built once from
+the model inventory and kept up to date whenever this extension writes an
+info file. Models added by other means are picked up from the inventory
+when a lookup misses, checking only the directory that was looked up.
+"""
+from __future__ import annotations
+import atexit
+import os
+import threading
+from . import util
+from . import json_codec
+from . import model
+from . import inventory
+
+INDEX_FILE = "versions.json"
+INDEX_VERSION = 1
+
+FLUSH_SECONDS = 5
+
+_lock = threading.Lock()
+
+# {"{model_id}:{version_id}": [model_path]}
+_index = None
+
+_flush_timer = None
+
+
+def make_key(model_id, version_id) -> str:
+    """ return: index key for a model version """
+    return f"{model_id}:{version_id}"
+
+
+def get_index_path() -> str:
+    """ return: path to the persisted index """
+    return os.path.join(util.get_cache_dir(), INDEX_FILE)
+
+
+def load_index() -> dict:
+    """ Loads the persisted index, building it if it does not exist yet """
+    global _index
+
+    if _index is not None:
+        return _index
+
+    path = get_index_path()
+    if os.path.isfile(path):
+        try:
+            data = json_codec.load_file(path)
+
+            if data.get("version", None) == INDEX_VERSION:
+                _index = data.get("models", {})
+                return _index
+
+        except (OSError, ValueError) as e:
+            util.printD(f"Could not load model version index, rebuilding it: {e}")
+
+    _index = build_index()
+    save_index()
+
+    return _index
+
+
+def build_index() -> dict:
+    """
+    Reads the ids of every model with an info file.
+
+    return: dict:index
+    """
+    util.printD("Building model version index")
+
+    index = {}
+    for folder in set(model.folders.values()):
+        if not (folder and os.path.isdir(folder)):
+            continue
+
+        for record in inventory.get_folder(folder)["models"].values():
+            ids = inventory.get_info_ids(record)
+            if not ids:
+                continue
+
+            paths = index.setdefault(make_key(*ids), [])
+            if record["path"] not in paths:
+                paths.append(record["path"])
+
+    return index
+
+
+def save_index() -> None:
+    """ Writes the index to disk """
+    global _flush_timer
+
+    with _lock:
+        if _flush_timer:
+            _flush_timer.cancel()
+            _flush_timer = None
+
+        if _index is None:
+            return
+
+        data = {
+            "version": INDEX_VERSION,
+            "models": _index,
+        }
+
+        try:
+            util.write_json_atomic(get_index_path(), data, durable=False)
+        except OSError as e:
+            util.printD(f"Could not save model version index: {e}")
+
+
+def mark_dirty() -> None:
+    """ Schedules a write of the index, batching changes made close together """
+    global _flush_timer
+
+    with _lock:
+        if _flush_timer:
+            return
+
+        _flush_timer = threading.Timer(FLUSH_SECONDS, save_index)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def flush() -> None:
+    """ Writes the index now if it has pending changes """
+    if _flush_timer:
+        save_index()
+
+
+atexit.register(flush)
+
+
+def add(model_path:str, model_info:dict) -> None:
+    """ Records the model version described by `model_info` at `model_path` """
+    model_id = model_info.get("modelId", "")
+    version_id = model_info.get("id", "")
+    if not (model_id and version_id):
+        return
+
+    model_path = os.path.normpath(model_path)
+    key = make_key(model_id, version_id)
+
+    index = load_index()
+    with _lock:
+        paths = index.setdefault(key, [])
+        if model_path in paths:
+            return
+        paths.append(model_path)
+
+    mark_dirty()
+
+
+def move(old_path:str, new_path:str) -> None:
+    """ Updates the index after a model has been renamed or moved """
+    old_path = os.path.normpath(old_path)
+    new_path = os.path.normpath(new_path)
+
+    changed = False
+    index = load_index()
+    with _lock:
+        for paths in index.values():
+            if old_path in paths:
+                paths[paths.index(old_path)] = new_path
+                changed = True
+
+    if changed:
+        mark_dirty()
+
+
+def index_directory(directory:str) -> bool:
+    """
+    Adds the models in a directory from the inventory, for models that
+    were added without this extension. Only the directory itself is
+    checked for changes, so a miss stays cheap.
+
+    return: True if any model was added
+    """
+    dir_index = inventory.refresh_directory(directory)
+    if dir_index is None and os.path.isdir(directory):
+        # not indexed yet, e.g. a new subfolder
+        for folder in set(model.folders.values()):
+            if not (folder and os.path.isdir(folder)):
+                continue
+
+            folder = os.path.normpath(folder)
+            if os.path.commonpath([folder, directory]) == folder:
+                inventory.get_folder(folder, force_refresh=True)
+
+        dir_index = inventory.refresh_directory(directory)
+
+    if dir_index is None:
+        return False
+
+    added = False
+    index = load_index()
+    for record in list(dir_index["models"].values()):
+        ids = inventory.get_info_ids(record)
+        if not ids:
+            continue
+
+        with _lock:
+            paths = index.setdefault(make_key(*ids), [])
+            if record["path"] in paths:
+                continue
+            paths.append(record["path"])
+
+        added = True
+
+    if added:
+        mark_dirty()
+
+    return added
+
+
+def lookup(folder:str, model_id, version_id) -> str | None:
+    """
+    Finds a downloaded model version in a folder, not including subfolders.
+
+    return: model_path:str or None
+    """
+    folder = os.path.normpath(folder)
+    key = make_key(model_id, version_id)
+
+    found = find_indexed(folder, key)
+    if found is None and index_directory(folder):
+        found = find_indexed(folder, key)
+
+    return found
+
+
+def find_indexed(folder:str, key:str) -> str | None:
+    """
+    Finds a model version in a folder by its index key,
+    dropping paths that no longer exist.
+
+    return: model_path:str or None
+    """
+    index = load_index()
+    with _lock:
+        paths = list(index.get(key, []))
+
+    found = None
+    stale = []
+    for path in paths:
+        if not os.path.isfile(path):
+            stale.append(path)
+            continue
+
+        if os.path.dirname(path) == folder:
+            found = path
+
+    if stale:
+        with _lock:
+            remaining = [path for path in index.get(key, []) if path not in stale]
+            if remaining:
+                index[key] = remaining
+            else:
+                index.pop(key, None)
+
+        mark_dirty()
+
+    return found
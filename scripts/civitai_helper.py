@@ -13,8 +13,11 @@ from modules import script_callbacks
 from ch_lib import model
 from ch_lib import js_action_civitai
 from ch_lib import civitai
+from ch_lib import downloader
 from ch_lib import util
 from ch_lib import sections
+from ch_lib import inventory
+from ch_lib import download_manager
 from browser import browser
 
 try:
@@ -42,12 +45,28 @@ BUTTONS = {
 }
 
 model.get_custom_model_folder()
+inventory.start_watcher()
+
+
+def update_base_url():
+    """ Point API requests at the configured Civitai instance """
+    civitai.set_base_url(util.get_opts("ch_civitai_base_url"))
+
+
+update_base_url()
+
+# resume downloads interrupted by a restart
+download_manager.start()
 
 def update_proxy():
     """ Set proxy, allow for changes at runtime """
     proxy = util.get_opts("ch_proxy")
 
     util.printD(f"Set Proxy: {proxy}")
+
+    # drop connections made through the previous proxy
+    downloader.close_session()
+
     if proxy:
         util.PROXIES["http"] = proxy
         util.PROXIES["https"] = proxy
@@ -224,6 +243,143 @@ def on_ui_settings():
             {"interactive": True},
             section=section)
     )
+    shared.opts.add_option(
+        "ch_hash_workers",
+        shared.OptionInfo(
+            1,
+            (
+                "Number of model files to hash at the same time when scanning. "
+                "Higher values can speed up scanning on SSDs and network storage."
+            ),
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_extra_hashes",
+        shared.OptionInfo(
+            False,
+            (
+                "Also compute CRC32 and BLAKE3 hashes when hashing models. BLAKE3 "
+                "requires the blake3 python package."
+            ),
+            gr.Checkbox,
+            {"interactive": True},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_inventory_inotify",
+        shared.OptionInfo(
+            False,
+            (
+                "Watch model folders for changes with inotify instead of checking "
+                "every folder when refreshing the model list. Linux only, requires "
+                "the inotify_simple python package. Requires restart."
+            ),
+            gr.Checkbox,
+            {"interactive": True},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_api_rate",
+        shared.OptionInfo(
+            4,
+            "Maximum Civitai API requests per second",
+            gr.Slider,
+            {"minimum": 0.5, "maximum": 20, "step": 0.5},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_api_burst",
+        shared.OptionInfo(
+            8,
+            "Civitai API requests that can be sent at once before the rate limit applies",
+            gr.Slider,
+            {"minimum": 1, "maximum": 50, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_api_workers",
+        shared.OptionInfo(
+            4,
+            "Number of Civitai API requests to run at the same time",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_api_cache_size",
+        shared.OptionInfo(
+            64,
+            (
+                "Maximum size in MB of the cache of Civitai API responses. "
+                "Set to 0 to disable the cache."
+            ),
+            gr.Slider,
+            {"minimum": 0, "maximum": 1024, "step": 16},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_segments",
+        shared.OptionInfo(
+            1,
+            (
+                "Number of connections to download large model files over. "
+                "Higher values can be faster when Civitai limits the speed of "
+                "each connection."
+            ),
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_concurrency",
+        shared.OptionInfo(
+            2,
+            "Number of queued downloads to run at the same time",
+            gr.Slider,
+            {"minimum": 1, "maximum": 8, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_per_host",
+        shared.OptionInfo(
+            2,
+            "Number of queued downloads to run at the same time from a single host",
+            gr.Slider,
+            {"minimum": 1, "maximum": 8, "step": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_bandwidth",
+        shared.OptionInfo(
+            0,
+            "Combined speed limit of all downloads in MB/s. 0 means no limit.",
+            gr.Slider,
+            {"minimum": 0, "maximum": 200, "step": 0.5},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_offpeak_hours",
+        shared.OptionInfo(
+            "",
+            (
+                "Off-peak hours for large batch downloads, e.g. \"22:00-06:00, 12:00-13:30\". "
+                "Outside these hours they stay queued. Leave empty to download at any time."
+            ),
+            gr.Textbox,
+            {"interactive": True, "max_lines": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_dl_offpeak_size",
+        shared.OptionInfo(
+            100,
+            "Batch downloads of at least this many MB wait for off-peak hours",
+            gr.Slider,
+            {"minimum": 0, "maximum": 10000, "step": 10},
+            section=section)
+    )
     shared.opts.add_option(
         "ch_dl_lyco_to_lora",
         shared.OptionInfo(
@@ -329,6 +485,30 @@ def on_ui_settings():
             {"interactive": True, "max_lines": 1},
             section=section)
     )
+    shared.opts.add_option(
+        "ch_civitai_base_url",
+        shared.OptionInfo(
+            "",
+            (
+                "Civitai API base URL. Leave empty to use https://civitai.com. "
+                "Used for testing against a local stand-in server."
+            ),
+            gr.Textbox,
+            {"interactive": True, "max_lines": 1},
+            section=section)
+    )
+    shared.opts.add_option(
+        "ch_compact_json",
+        shared.OptionInfo(
+            False,
+            (
+                "Write model info files without indentation. They are smaller and "
+                "faster to read and write, but harder to edit by hand."
+            ),
+            gr.Checkbox,
+            {"interactive": True},
+            section=section)
+    )
     shared.opts.add_option(
         "ch_clean_html",
         shared.OptionInfo(
@@ -365,6 +545,10 @@ def on_ui_settings():
         "ch_proxy",
         update_proxy
     )
+    shared.opts.onchange(
+        "ch_civitai_base_url",
+        update_base_url
+    )
 
 util.GRADIO_FALLBACK = not util.newer_version(gr.__version__, "3.42.0")
 
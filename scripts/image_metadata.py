@@ -5,6 +5,7 @@ from pathlib import Path
 from functools import reduce
 
 from ch_lib import util
+from ch_lib import json_codec
 from modules import script_callbacks, extra_networks, prompt_parser, processing, sd_models, infotext_utils
 import networks # extensions-builtin\sd_forge_lora\networks.py
 try:
@@ -36,18 +37,17 @@ def add_resource_metadata(params):
         try:
             # Read civitai metadata from previously generated info file
             file_path = Path(base_file_path).with_suffix(".civitai.info")
-            with open(file_path, 'r') as file:
-                civitai_info = json.load(file)
-                resource_data = {}
-                resource_data["type"] = type_name if type_name is not None else civitai_info["model"]["type"].lower()
-                if resource_data["type"] in ["locon", "loha"]:
-                    resource_data["type"] = "lycoris"
-                if weight is not None:
-                    resource_data["weight"] = weight
-                resource_data["modelVersionId"] = civitai_info["id"]
-                resource_data["modelName"] = civitai_info["model"]["name"]
-                resource_data["modelVersionName"] = civitai_info["name"]
-                civitai_resource_list.append(resource_data)
+            civitai_info = json_codec.load_file(file_path)
+            resource_data = {}
+            resource_data["type"] = type_name if type_name is not None else civitai_info["model"]["type"].lower()
+            if resource_data["type"] in ["locon", "loha"]:
+                resource_data["type"] = "lycoris"
+            if weight is not None:
+                resource_data["weight"] = weight
+            resource_data["modelVersionId"] = civitai_info["id"]
+            resource_data["modelName"] = civitai_info["model"]["name"]
+            resource_data["modelVersionName"] = civitai_info["name"]
+            civitai_resource_list.append(resource_data)
         except FileNotFoundError:
             util.printD(f"Warning: '{file_path}' not found. Did you forget to scan?")
         except Exception as e:
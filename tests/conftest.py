@@ -0,0 +1,107 @@
+""" -*- coding: UTF-8 -*-
+Test setup.
+
+Civitai Helper runs inside webui, so the webui modules it imports are
+replaced here with minimal stand-ins. Everything else it needs must be
+installed as usual.
+"""
+import os
+import sys
+import threading
+import types
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+
+class Options:
+    """ Stand-in for webui's shared.opts """
+
+    def __init__(self):
+        self.data = {}
+
+    def add_option(self, key, info):
+        self.data.setdefault(key, getattr(info, "default", None))
+
+    def onchange(self, *args, **kwargs):
+        pass
+
+
+def add_module(name:str, **attrs) -> types.ModuleType:
+    """ Registers a stand-in module """
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
+
+
+def install_webui_modules() -> None:
+    """ Registers stand-ins for the parts of webui used by ch_lib """
+    caches = {}
+
+    add_module("modules")
+    add_module(
+        "modules.shared",
+        opts=Options(),
+        cmd_opts=types.SimpleNamespace(no_hashing=False),
+        OptionInfo=lambda default=None, *args, **kwargs: types.SimpleNamespace(default=default),
+    )
+    add_module(
+        "modules.cache",
+        cache=lambda name: caches.setdefault(name, {}),
+        dump_cache=lambda: None,
+    )
+    add_module("modules.hashes", sha256_from_cache=lambda *args, **kwargs: None)
+    add_module("modules.paths_internal", data_path=os.path.join(ROOT, "cache", "tests"))
+    add_module("modules.sd_models")
+
+    try:
+        import gradio  # pylint: disable=unused-import,import-outside-toplevel
+    except ImportError:
+        add_module("gradio", Info=print, Warning=print, Error=print, __version__="4.0")
+
+
+install_webui_modules()
+
+
+@pytest.fixture
+def opts(tmp_path, monkeypatch):
+    """ Settings for a test, with caches kept in a temporary directory """
+    from ch_lib import util  # pylint: disable=import-outside-toplevel
+    from modules import shared  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.setattr(util, "script_dir", str(tmp_path))
+    monkeypatch.setattr(shared.opts, "data", {})
+
+    return shared.opts.data
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Starts the local Civitai stand-in. Call the fixture with
+    server options to get the server.
+    """
+    import civitai_stub_server  # pylint: disable=import-outside-toplevel
+
+    servers = []
+
+    def start(*argv):
+        options = civitai_stub_server.parse_args(["--port", "0", *argv])
+        server = civitai_stub_server.StubServer((options.host, options.port), options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
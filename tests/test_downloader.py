@@ -0,0 +1,70 @@
+""" -*- coding: UTF-8 -*-
+Tests for ch_lib.downloader against the local Civitai stand-in.
+"""
+import hashlib
+import os
+import pytest
+import civitai_stub_server
+from ch_lib import downloader
+from ch_lib import json_codec
+
+VERSION_ID = 2001
+FILE_SIZE = 4 * 1024 * 1024
+
+
+def expected_sha256() -> str:
+    """ return: sha256 of the file the stand-in serves """
+    return civitai_stub_server.file_sha256(VERSION_ID, FILE_SIZE).lower()
+
+
+def run_download(url:str, file_path:str):
+    """ return: the final result of dl_file """
+    result = None
+    for output in downloader.dl_file(url, file_path=file_path, duplicate="Overwrite"):
+        if not isinstance(output, str):
+            result = output
+
+    return result
+
+
+@pytest.fixture
+def segmented(opts, monkeypatch):
+    """ Downloads small files in four segments """
+    opts["ch_dl_segments"] = 4
+    monkeypatch.setattr(downloader, "SEGMENT_MIN_SIZE", 1024 * 1024)
+
+
+def test_segmented_download(segmented, stub_server, tmp_path):
+    server = stub_server("--file-size", str(FILE_SIZE))
+    file_path = str(tmp_path / "model.safetensors")
+
+    result = run_download(f"{server.base_url}/api/download/models/{VERSION_ID}", file_path)
+
+    assert result == (True, file_path)
+    with open(file_path, "rb") as model_file:
+        assert hashlib.sha256(model_file.read()).hexdigest() == expected_sha256()
+
+
+@pytest.mark.parametrize("resume", [False, True])
+def test_ignored_range_falls_back_to_single_stream(segmented, stub_server, tmp_path, resume):
+    server = stub_server("--file-size", str(FILE_SIZE), "--ignore-range")
+    url = f"{server.base_url}/api/download/models/{VERSION_ID}"
+    file_path = str(tmp_path / "model.safetensors")
+
+    if resume:
+        # saved progress of an earlier segmented download
+        with open(f"{file_path}{downloader.DL_EXT}", "wb") as partial_file:
+            partial_file.truncate(FILE_SIZE)
+        json_codec.dump_file(downloader.get_state_path(file_path), {
+            "url": url,
+            "total_size": FILE_SIZE,
+            "job": None,
+            "segments": downloader.plan_segments(FILE_SIZE, 4),
+        })
+
+    result = run_download(url, file_path)
+
+    assert result == (True, file_path)
+    assert not os.path.exists(downloader.get_state_path(file_path))
+    with open(file_path, "rb") as model_file:
+        assert hashlib.sha256(model_file.read()).hexdigest() == expected_sha256()
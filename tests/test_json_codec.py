@@ -0,0 +1,36 @@
+""" -*- coding: UTF-8 -*-
+Tests for ch_lib.json_codec.
+"""
+import json
+import pytest
+from ch_lib import json_codec
+
+DATA = {
+    "id": 2001,
+    "name": "Ünïcode ✓",
+    "trainedWords": ["a", "b"],
+    "stats": {"rating": 4.5, "nsfw": False, "empty": None},
+    "files": [],
+}
+
+BACKENDS = [
+    backend for backend, module in (
+        ("json", json),
+        ("orjson", json_codec.orjson),
+        ("msgspec", json_codec.msgspec),
+    ) if module
+]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_pretty_output_is_the_same_for_every_backend(backend, monkeypatch):
+    monkeypatch.setattr(json_codec, "BACKEND", backend)
+
+    assert json_codec.dumps(DATA, pretty=True) == json.dumps(DATA, indent=4).encode("utf-8")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_compact_output_round_trips(backend, monkeypatch):
+    monkeypatch.setattr(json_codec, "BACKEND", backend)
+
+    assert json_codec.loads(json_codec.dumps(DATA)) == DATA
@@ -0,0 +1,464 @@
+""" -*- coding: UTF-8 -*-
+Local stand-in for the Civitai API, for offline testing and benchmarking.
+
+Serves the endpoints Civitai Helper uses from JSON fixtures:
+
+    GET  /api/v1/models/{id}
+    GET  /api/v1/models?ids=...&limit=...&cursor=...
+    GET  /api/v1/models?{any other query}
+    GET  /api/v1/model-versions/{id}
+    GET  /api/v1/model-versions/by-hash/{hash}
+    POST /api/v1/model-versions/by-hash
+    GET  /api/download/models/{version_id}
+
+Model files are generated on the fly, so fixtures do not need to contain
+them. The content is deterministic per version, and Range requests are
+supported. --ignore-range answers them with the whole file instead, like
+servers that advertise ranges but do not honour them.
+
+Fixtures live in a directory laid out as:
+
+    models/{model_id}.json
+    model-versions/{version_id}.json
+    query/{sha1 of the query string}.json
+
+Version fixtures are also used for by-hash lookups, matched against the
+hashes of their files. URLs pointing at civitai.com in served fixtures
+are rewritten to point at this server.
+
+Usage:
+
+    python tools/civitai_stub_server.py --port 8765 --latency 0.05 \\
+        --error-rate 0.1 --error-codes 429,503
+
+Then set "Civitai API base URL" in Civitai Helper's settings to
+http://127.0.0.1:8765
+
+Record mode forwards requests that have no fixture to the real site and
+saves the responses as fixtures for later runs:
+
+    python tools/civitai_stub_server.py --record https://civitai.com
+
+Only the standard library is used, so this runs without webui.
+"""
+from __future__ import annotations
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CIVITAI = "https://civitai.com"
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# served when a version fixture does not give a file size
+DEFAULT_FILE_SIZE = 1 << 20  # 1 MiB
+BLOCK_SIZE = 1 << 16  # 64 KiB
+
+MODEL_RE = re.compile(r"^/api/v1/models/(\d+)$")
+VERSION_RE = re.compile(r"^/api/v1/model-versions/(\d+)$")
+HASH_RE = re.compile(r"^/api/v1/model-versions/by-hash/([0-9A-Fa-f]+)$")
+DOWNLOAD_RE = re.compile(r"^/api/download/models/(\d+)$")
+
+
+def generate_block(version_id:int, index:int) -> bytes:
+    """ return: a deterministic block of model file content """
+    seed = hashlib.sha256(f"{version_id}:{index}".encode("utf-8")).digest()
+    return seed * (BLOCK_SIZE // len(seed))
+
+
+def generate_range(version_id:int, start:int, end:int):
+    """ yields: model file content from start to end, inclusive """
+    pos = start
+    while pos <= end:
+        index, offset = divmod(pos, BLOCK_SIZE)
+        block = generate_block(version_id, index)
+        chunk = block[offset:min(BLOCK_SIZE, offset + end - pos + 1)]
+        yield chunk
+        pos = pos + len(chunk)
+
+
+def file_sha256(version_id:int, size:int) -> str:
+    """ return: sha256 of a generated model file, for writing fixtures """
+    sha256 = hashlib.sha256()
+    for chunk in generate_range(version_id, 0, size - 1):
+        sha256.update(chunk)
+    return sha256.hexdigest().upper()
+
+
+class Fixtures:
+    """ Fixture storage, see module docstring for the layout """
+
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes = None
+
+    def file_path(self, kind:str, name:str) -> str:
+        return os.path.join(self.path, kind, f"{name}.json")
+
+    def load(self, kind:str, name:str):
+        try:
+            with open(self.file_path(kind, name), "r", encoding="utf-8") as fixture:
+                return json.load(fixture)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, kind:str, name:str, data) -> None:
+        path = self.file_path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            with open(path, "w", encoding="utf-8") as fixture:
+                json.dump(data, fixture, indent=4)
+            self.hashes = None
+
+    def find_by_hash(self, model_hash:str):
+        """ return: version fixture with a file matching model_hash, or None """
+        with self.lock:
+            if self.hashes is None:
+                self.hashes = {}
+                pattern = os.path.join(self.path, "model-versions", "*.json")
+                for path in glob.glob(pattern):
+                    name = os.path.splitext(os.path.basename(path))[0]
+                    version = self.load("model-versions", name) or {}
+                    for file_info in version.get("files", []):
+                        for value in file_info.get("hashes", {}).values():
+                            self.hashes[f"{value}".upper()] = name
+
+            name = self.hashes.get(model_hash.upper(), None)
+
+        return self.load("model-versions", name) if name else None
+
+
+class StubServer(ThreadingHTTPServer):
+    """ HTTP server holding the stand-in's configuration """
+
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, StubHandler)
+        self.fixtures = Fixtures(options.fixtures)
+        self.latency = options.latency
+        self.error_rate = options.error_rate
+        self.error_codes = options.error_codes
+        self.record = options.record.rstrip("/") if options.record else None
+        self.file_size = options.file_size
+        self.ignore_range = options.ignore_range
+        self.base_url = f"http://{address[0]}:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Handles requests for the stand-in Civitai API """
+
+    server: StubServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        print(f"stub: {format % args}")
+
+    def send_json(self, data, status=200) -> None:
+        text = json.dumps(data).replace(f"{CIVITAI}/", f"{self.server.base_url}/")
+        body = text.encode("utf-8")
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+        if status == 200 and self.headers.get("If-None-Match", None) == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_status(self, status:int) -> None:
+        body = json.dumps({"error": f"Injected error {status}"}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject(self) -> bool:
+        """ Applies latency and error injection. return: True if an error was sent """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.error_codes and random.random() < self.server.error_rate:
+            status = random.choice(self.server.error_codes)
+            if status == 416 and "Range" not in self.headers:
+                status = 503
+            self.send_error_status(status)
+            return True
+
+        return False
+
+    def fetch_upstream(self, body:bytes | None=None, path:str | None=None):
+        """ Forwards the request to the recorded site. return: (status, json) """
+        url = f"{self.server.record}{path or self.path}"
+        headers = {"User-Agent": self.headers.get("User-Agent", "civitai-stub")}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+
+        request = urllib.request.Request(url, data=body, headers=headers, method=self.command)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return (response.status, json.load(response))
+        except urllib.error.HTTPError as e:
+            return (e.code, None)
+        except (urllib.error.URLError, ValueError):
+            return (502, None)
+
+    def serve_fixture(self, kind:str, name:str) -> None:
+        data = self.server.fixtures.load(kind, name)
+
+        if data is None and self.server.record:
+            status, data = self.fetch_upstream()
+            if data is None:
+                self.send_error_status(status)
+                return
+            self.server.fixtures.save(kind, name, data)
+
+        if data is None:
+            self.send_json({"error": "Not found"}, 404)
+            return
+
+        self.send_json(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.inject():
+            return
+
+        parsed = urllib.parse.urlparse(self.path)
+
+        match = MODEL_RE.match(parsed.path)
+        if match:
+            self.serve_fixture("models", match.group(1))
+            return
+
+        match = VERSION_RE.match(parsed.path)
+        if match:
+            self.serve_fixture("model-versions", match.group(1))
+            return
+
+        match = HASH_RE.match(parsed.path)
+        if match:
+            self.serve_hash(match.group(1))
+            return
+
+        match = DOWNLOAD_RE.match(parsed.path)
+        if match:
+            self.serve_download(int(match.group(1)))
+            return
+
+        if parsed.path == "/api/v1/models":
+            self.serve_query(parsed.query)
+            return
+
+        self.send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if self.inject():
+            return
+
+        if urllib.parse.urlparse(self.path).path.rstrip("/") != "/api/v1/model-versions/by-hash":
+            self.send_json({"error": "Not found"}, 404)
+            return
+
+        try:
+            hashes = json.loads(body)
+        except ValueError:
+            self.send_json({"error": "Invalid JSON"}, 400)
+            return
+
+        found = []
+        missing = []
+        for model_hash in hashes:
+            version = self.server.fixtures.find_by_hash(f"{model_hash}")
+            if version is None:
+                missing.append(model_hash)
+            elif version not in found:
+                found.append(version)
+
+        if missing and self.server.record:
+            status, data = self.fetch_upstream(json.dumps(missing).encode("utf-8"))
+            for version in data or []:
+                self.server.fixtures.save("model-versions", f"{version['id']}", version)
+                found.append(version)
+
+        self.send_json(found)
+
+    def serve_hash(self, model_hash:str) -> None:
+        version = self.server.fixtures.find_by_hash(model_hash)
+
+        if version is None and self.server.record:
+            status, version = self.fetch_upstream()
+            if version is None:
+                self.send_error_status(status)
+                return
+            self.server.fixtures.save("model-versions", f"{version['id']}", version)
+
+        if version is None:
+            self.send_json({"error": "Model not found"}, 404)
+            return
+
+        self.send_json(version)
+
+    def serve_query(self, query:str) -> None:
+        params = urllib.parse.parse_qs(query)
+        ids = [
+            model_id for value in params.get("ids", [])
+            for model_id in value.split(",") if model_id
+        ]
+
+        if not ids:
+            name = hashlib.sha1(query.encode("utf-8")).hexdigest()
+            self.serve_fixture("query", name)
+            return
+
+        limit = int(params.get("limit", ["100"])[0])
+        cursor = int(params.get("cursor", ["0"])[0])
+
+        items = []
+        for model_id in ids:
+            model_info = self.server.fixtures.load("models", model_id)
+            if model_info is None and self.server.record:
+                _, model_info = self.fetch_upstream(path=f"/api/v1/models/{model_id}")
+                if model_info:
+                    self.server.fixtures.save("models", model_id, model_info)
+            if model_info:
+                items.append(model_info)
+
+        page = items[cursor:cursor + limit]
+        metadata = {}
+        if cursor + limit < len(items):
+            next_params = dict(params)
+            next_params["cursor"] = [f"{cursor + limit}"]
+            next_query = urllib.parse.urlencode(next_params, doseq=True)
+            metadata["nextCursor"] = cursor + limit
+            metadata["nextPage"] = f"{self.server.base_url}/api/v1/models?{next_query}"
+
+        self.send_json({"items": page, "metadata": metadata})
+
+    def get_file_info(self, version_id:int) -> tuple[str, int]:
+        """ return: (filename, size) of a version's primary file """
+        filename = f"model-{version_id}.safetensors"
+        size = self.server.file_size or DEFAULT_FILE_SIZE
+
+        version = self.server.fixtures.load("model-versions", f"{version_id}") or {}
+        for file_info in version.get("files", []):
+            if file_info.get("primary", False) or len(version["files"]) == 1:
+                filename = file_info.get("name", filename)
+                if not self.server.file_size and file_info.get("sizeKB", 0):
+                    size = int(file_info["sizeKB"] * 1024)
+                break
+
+        return (filename, size)
+
+    def serve_download(self, version_id:int) -> None:
+        filename, size = self.get_file_info(version_id)
+
+        start = 0
+        end = size - 1
+        status = 200
+
+        range_header = self.headers.get("Range", None)
+        if range_header and not self.server.ignore_range:
+            match = re.match(r"bytes=(\d*)-(\d*)$", range_header.strip())
+            if not match or not (match.group(1) or match.group(2)):
+                self.send_error_status(416)
+                return
+
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
+
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if self.command == "HEAD":
+            return
+
+        try:
+            for chunk in generate_range(version_id, start, end):
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    do_HEAD = do_GET
+
+
+def parse_args(argv=None):
+    """ return: command line options """
+    parser = argparse.ArgumentParser(description="Local stand-in for the Civitai API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES, help="fixture directory")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail")
+    parser.add_argument(
+        "--error-codes", default="429,503",
+        type=lambda value: [int(code) for code in value.split(",") if code],
+        help="comma separated status codes to fail with, e.g. 429,500,503,416"
+    )
+    parser.add_argument("--file-size", type=int, default=0, help="size of served model files in bytes")
+    parser.add_argument("--record", default=None, help="site to record missing fixtures from")
+    parser.add_argument(
+        "--ignore-range", action="store_true",
+        help="send whole files in answer to Range requests"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Runs the server until interrupted """
+    options = parse_args(argv)
+    server = StubServer((options.host, options.port), options)
+    print(f"Civitai stand-in serving {options.fixtures} on {server.base_url}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()